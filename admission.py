@@ -0,0 +1,169 @@
+"""Допуск запросов к OpenAI в пределах лимитов запросов и токенов в минуту.
+
+Лимиты OpenAI действуют на каждую модель отдельно, поэтому у каждой модели
+свой AdmissionController. Лимит 0 означает, что ведро не ограничивает допуск.
+"""
+import asyncio
+import heapq
+import itertools
+import random
+import time
+
+
+class TokenBucket:
+    """Ведро токенов, пополняемое равномерно до емкости rate_per_minute; 0 — без ограничения."""
+
+    def __init__(self, rate_per_minute):
+        self.capacity = float(rate_per_minute)
+        self.rate = self.capacity / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def time_until(self, amount, now):
+        """Сколько секунд ждать, пока в ведре наберется amount (не больше емкости)."""
+        if not self.rate:
+            return 0.0
+        self._refill(now)
+        missing = min(amount, self.capacity) - self.level
+        return missing / self.rate if missing > 0 else 0.0
+
+    def consume(self, amount, now):
+        if not self.rate:
+            return
+        self._refill(now)
+        self.level -= min(amount, self.capacity)
+
+
+def backoff_delay(attempt, base=0.5, cap=8.0, retry_after=None):
+    """Экспоненциальная задержка с полным джиттером; Retry-After от сервера — нижняя граница."""
+    delay = random.uniform(0, min(cap, base * 2 ** attempt))
+    if retry_after:
+        delay = max(delay, retry_after)
+    return delay
+
+
+class AdmissionController:
+    """Очередь с приоритетами перед запросами к OpenAI.
+
+    Запрос допускается, когда в ведрах запросов (RPM) и токенов (TPM) хватает
+    емкости. Меньший priority обслуживается раньше: пользователи, уже ведущие
+    диалог, не ждут за новыми. После ответа 429 допуск приостанавливается.
+
+    Стоимость запроса в токенах оценивается по длине текста; calibrate()
+    уточняет оценку по usage.prompt_tokens из ответов OpenAI.
+    """
+
+    CALIBRATION_WEIGHT = 0.2  # вес нового замера в скользящем среднем
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.prompt_ratio = 1.0  # фактические токены промпта / оценка по длине
+        self._queue = []
+        self._counter = itertools.count()
+        self._condition = asyncio.Condition()
+        self.paused_until = 0.0
+        self.admitted = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.retries = 0
+        self.rate_limited = 0
+        self.degraded = 0
+
+    def pause(self, seconds):
+        """Приостанавливает допуск после 429: ведра не знают о чужой нагрузке на тот же ключ."""
+        self.rate_limited += 1
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def cost(self, estimated_prompt_tokens, max_completion_tokens):
+        """Токены, которые запрос займет в ведре TPM, с поправкой на калибровку."""
+        return int(estimated_prompt_tokens * self.prompt_ratio) + max_completion_tokens
+
+    def calibrate(self, estimated_prompt_tokens, actual_prompt_tokens):
+        """Уточняет оценку промпта по usage.prompt_tokens из ответа OpenAI."""
+        if estimated_prompt_tokens <= 0 or not actual_prompt_tokens:
+            return
+        ratio = actual_prompt_tokens / estimated_prompt_tokens
+        self.prompt_ratio += self.CALIBRATION_WEIGHT * (ratio - self.prompt_ratio)
+
+    def expected_wait(self, tokens, priority=1):
+        """Примерное ожидание нового запроса: очередь перед ним плюс его собственная стоимость.
+
+        По нему выбирают модель до постановки в очередь, пока ожидание еще не потрачено.
+        """
+        now = time.monotonic()
+        ahead = [entry for entry in self._queue if entry[0] <= priority]
+        wait = max(0.0, self.paused_until - now)
+        if self.requests.rate:
+            wait = max(wait, self.requests.time_until(len(ahead) + 1, now)
+                       + max(0, len(ahead) + 1 - self.requests.capacity) / self.requests.rate)
+        if self.tokens.rate:
+            queued = sum(entry[2] for entry in ahead) + tokens
+            wait = max(wait, self.tokens.time_until(queued, now)
+                       + max(0.0, queued - self.tokens.capacity) / self.tokens.rate)
+        return wait
+
+    def _delay(self, tokens, now):
+        return max(
+            self.paused_until - now,
+            self.requests.time_until(1, now),
+            self.tokens.time_until(tokens, now),
+        )
+
+    async def admit(self, tokens, priority=1):
+        """Ждет своей очереди и емкости в ведрах. Возвращает время ожидания в секундах."""
+        started = time.monotonic()
+        entry = (priority, next(self._counter), tokens)
+        async with self._condition:
+            heapq.heappush(self._queue, entry)
+            try:
+                while True:
+                    if self._queue[0] is entry:
+                        now = time.monotonic()
+                        delay = self._delay(tokens, now)
+                        if delay <= 0:
+                            heapq.heappop(self._queue)
+                            self.requests.consume(1, now)
+                            self.tokens.consume(tokens, now)
+                            break
+                        try:
+                            await asyncio.wait_for(self._condition.wait(), delay)
+                        except asyncio.TimeoutError:
+                            pass
+                    else:
+                        await self._condition.wait()
+            except BaseException:
+                # Отмененный запрос убираем из очереди, чтобы не блокировать остальных
+                if entry in self._queue:
+                    self._queue.remove(entry)
+                    heapq.heapify(self._queue)
+                raise
+            finally:
+                self._condition.notify_all()
+        wait = time.monotonic() - started
+        self.admitted += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        return wait
+
+    def stats(self):
+        now = time.monotonic()
+        self.requests._refill(now)
+        self.tokens._refill(now)
+        return {
+            'queue_depth': len(self._queue),
+            'requests_available': round(self.requests.level, 1),
+            'tokens_available': round(self.tokens.level),
+            'prompt_ratio': round(self.prompt_ratio, 2),
+            'paused_for': round(max(0.0, self.paused_until - now), 1),
+            'admitted': self.admitted,
+            'avg_wait': self.total_wait / self.admitted if self.admitted else 0.0,
+            'max_wait': self.max_wait,
+            'retries': self.retries,
+            'rate_limited': self.rate_limited,
+            'degraded': self.degraded,
+        }
@@ -0,0 +1,72 @@
+"""LRU-кэш готовых ответов на повторяющиеся вопросы."""
+import re
+import time
+from collections import OrderedDict
+
+PUNCTUATION_RE = re.compile(r"[^\w\s]+", re.UNICODE)
+
+
+def compile_synonyms(synonyms):
+    """Список (регулярное выражение синонима, каноничное название), длинные фразы первыми."""
+    pairs = []
+    for canonical, aliases in synonyms.items():
+        for alias in set(aliases) | {canonical}:
+            pairs.append((alias.lower().replace('ё', 'е'), canonical))
+    pairs.sort(key=lambda pair: len(pair[0]), reverse=True)
+    return [(re.compile(r"\b" + re.escape(alias) + r"\b"), canonical) for alias, canonical in pairs]
+
+
+def normalize_question(text, compiled_synonyms=()):
+    """Приводит вопрос к каноничной форме: регистр, пунктуация, названия курсов."""
+    text = text.lower().replace('ё', 'е')
+    for pattern, canonical in compiled_synonyms:
+        text = pattern.sub(canonical, text)
+    text = PUNCTUATION_RE.sub(" ", text)
+    return " ".join(text.split())
+
+
+class AnswerCache:
+    """LRU-кэш с ограничением по времени жизни записей и счетчиками попаданий."""
+
+    def __init__(self, max_size=1000, ttl_seconds=3600):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, expires_at = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self._entries[key] = (value, time.monotonic() + self.ttl_seconds)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
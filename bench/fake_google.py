@@ -0,0 +1,98 @@
+"""Заглушки Google Sheets и Google Docs для запуска бота без учетных данных.
+
+gspread и googleapiclient обращаются к жестко заданным адресам Google, поэтому
+вместо HTTP-сервера подставляются объекты с тем же интерфейсом, который
+использует telegram_bot: open_by_key().worksheet().get_all_records() и
+documents().get().execute(). Данные берутся из bench/data.
+"""
+import json
+import os
+import time
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+# Колонки кыргызской версии курса в таблице (см. parse_course_records)
+KY_COLUMNS = {
+    'Название курса': 'Название курса (Кырг.)',
+    'Описание': 'Описание (Кырг.)',
+    'график учебы': 'график учебы (Кырг.)',
+    'возрастное ограничение': 'возрастное ограничение (Кырг.)',
+}
+
+
+def load_course_records(path=os.path.join(DATA, 'courses.json')):
+    """Строки таблицы курсов: русские колонки плюс кыргызские "(Кырг.)"."""
+    with open(path, encoding='utf-8') as f:
+        courses = json.load(f)
+    records = []
+    for course_ru, course_ky in zip(courses['ru'], courses['ky']):
+        record = dict(course_ru)
+        record.update({column: course_ky[field] for field, column in KY_COLUMNS.items()})
+        records.append(record)
+    return records
+
+
+class FakeWorksheet:
+    def __init__(self, records, latency):
+        self.records = records
+        self.latency = latency
+
+    def get_all_records(self):
+        time.sleep(self.latency)
+        return [dict(record) for record in self.records]
+
+
+class FakeSpreadsheet:
+    def __init__(self, worksheet):
+        self._worksheet = worksheet
+
+    def worksheet(self, title):
+        return self._worksheet
+
+
+class FakeSheetsClient:
+    """Аналог gspread.Client с одной таблицей курсов."""
+
+    def __init__(self, records=None, latency=0.2):
+        self.spreadsheet = FakeSpreadsheet(FakeWorksheet(records or load_course_records(), latency))
+
+    def open_by_key(self, key):
+        return self.spreadsheet
+
+
+class _Call:
+    def __init__(self, result, latency):
+        self.result = result
+        self.latency = latency
+
+    def execute(self):
+        time.sleep(self.latency)
+        return self.result
+
+
+class _Documents:
+    def __init__(self, service):
+        self.service = service
+
+    def get(self, documentId, fields=None):
+        if fields == "revisionId":
+            return _Call({'revisionId': self.service.revision_id}, self.service.latency / 4)
+        return _Call(self.service.document(), self.service.latency)
+
+
+class FakeDocsService:
+    """Аналог ресурса Google Docs v1: документ из текстового файла базы знаний."""
+
+    def __init__(self, path=os.path.join(DATA, 'knowledge_base_ru.txt'), latency=0.3, revision_id="bench-1"):
+        with open(path, encoding='utf-8') as f:
+            self.text = f.read()
+        self.latency = latency
+        self.revision_id = revision_id
+
+    def document(self):
+        content = [{'paragraph': {'elements': [{'textRun': {'content': line}}]}}
+                   for line in self.text.splitlines(keepends=True)]
+        return {'revisionId': self.revision_id, 'body': {'content': content}}
+
+    def documents(self):
+        return _Documents(self)
@@ -0,0 +1,347 @@
+"""Локальные заглушки Telegram Bot API и OpenAI для нагрузочных тестов.
+
+Один asyncio HTTP/1.1 сервер (keep-alive, chunked) обслуживает:
+    /bot<token>/<method>        — Telegram Bot API (getUpdates с long polling, sendMessage, ...)
+    /file/bot<token>/<path>     — скачивание файлов (голосовых)
+    /v1/chat/completions        — OpenAI chat, обычный ответ или SSE-поток, с задержкой и 429
+    /v1/audio/transcriptions    — OpenAI Whisper, текст зашит в байты голосового
+
+Бот подключается к ним через TELEGRAM_API_BASE_URL и OPENAI_BASE_URL.
+"""
+import asyncio
+import json
+import random
+import re
+import time
+import urllib.parse
+
+# Заглушка голосового: заголовок Ogg и текст, который "распознает" Whisper
+VOICE_MARKER = re.compile(rb"BENCH\[(.*?)\]BENCH", re.S)
+
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 429: 'Too Many Requests'}
+
+FAKE_ANSWERS = {
+    'ru': "Спасибо за вопрос! В IT Run Academy есть курсы Python, Backend, Frontend, Scratch и Data Science. "
+          "Занятия проходят в Жалал-Абаде, пробный урок в субботу в 11:00. "
+          "Оставьте номер телефона, и менеджер свяжется с вами, чтобы подобрать удобную группу.",
+    'ky': "Сурооңуз үчүн рахмат! IT Run Academy'де Python, Backend, Frontend, Scratch жана Data Science курстары бар. "
+          "Сабактар Жалал-Абадда өтөт, сынамык сабак ишемби күнү саат 11:00дө. "
+          "Телефон номериңизди калтырыңыз, менеджер сиз менен байланышып, ыңгайлуу топту тандайт.",
+}
+KY_LETTERS = set('өүң')
+
+
+def voice_payload(text):
+    """Байты фейкового голосового сообщения с зашитой расшифровкой."""
+    return b"OggS\x00\x02" + b"BENCH[" + text.encode('utf-8') + b"]BENCH" + bytes(64)
+
+
+class Request:
+    __slots__ = ('method', 'path', 'query', 'headers', 'body')
+
+    def __init__(self, method, target, headers, body):
+        parsed = urllib.parse.urlsplit(target)
+        self.method = method
+        self.path = parsed.path
+        self.query = parsed.query
+        self.headers = headers
+        self.body = body
+
+    def form(self):
+        """Параметры запроса Telegram: query string и form-urlencoded тело."""
+        params = dict(urllib.parse.parse_qsl(self.query))
+        content_type = self.headers.get('content-type', '')
+        if self.body and 'application/x-www-form-urlencoded' in content_type:
+            params.update(urllib.parse.parse_qsl(self.body.decode('utf-8')))
+        elif self.body and 'application/json' in content_type:
+            params.update(json.loads(self.body))
+        return params
+
+
+class FakeServices:
+    """Заглушки Telegram и OpenAI с настраиваемой задержкой, потоковой выдачей и ответами 429."""
+
+    def __init__(self, chat_latency=0.8, chat_jitter=0.3, stream_chunk_delay=0.05, stream_chunk_words=3,
+                 whisper_latency=0.6, rate_limit_ratio=0.0, retry_after=1.0, telegram_latency=0.0, seed=None):
+        self.chat_latency = chat_latency
+        self.chat_jitter = chat_jitter
+        self.stream_chunk_delay = stream_chunk_delay
+        self.stream_chunk_words = stream_chunk_words
+        self.whisper_latency = whisper_latency
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+        self.telegram_latency = telegram_latency
+        self.random = random.Random(seed)
+        self.server = None
+        self.port = None
+        # Открытые соединения: writer -> задача, которая его обслуживает
+        self._connections = {}
+        self._closing = False
+        self.polling_started = asyncio.Event()
+        # Telegram: очередь входящих апдейтов и ответы бота по чатам
+        self._updates = []
+        self._update_id = 0
+        self._updates_changed = asyncio.Condition()
+        self._replies = {}
+        self._message_id = 0
+        self._files = {}
+        # Счетчики для отчета
+        self.counters = {
+            'chat_requests': 0, 'chat_streams': 0, 'rate_limited': 0, 'transcriptions': 0,
+            'send_message': 0, 'edit_message': 0, 'chat_action': 0, 'get_file': 0,
+        }
+        self.chat_in_flight = 0
+        self.max_chat_in_flight = 0
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    async def start(self, port=0):
+        self.server = await asyncio.start_server(self._handle_connection, '127.0.0.1', port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self.server is None:
+            return
+        self.server.close()
+        # Долгий опрос getUpdates завершаем сразу, а keep-alive соединения закрываем сами,
+        # как WebhookServer.stop: иначе их задачи отменяются при выходе из event loop
+        self._closing = True
+        async with self._updates_changed:
+            self._updates_changed.notify_all()
+        for writer in list(self._connections):
+            writer.close()
+        await asyncio.gather(*self._connections.values(), return_exceptions=True)
+        await self.server.wait_closed()
+
+    # --- Сторона пользователя: отправка апдейтов и ожидание ответов ---
+
+    async def push_update(self, payload):
+        """Ставит апдейт в очередь getUpdates. payload — содержимое апдейта без update_id."""
+        async with self._updates_changed:
+            self._update_id += 1
+            self._updates.append({'update_id': self._update_id, **payload})
+            self._updates_changed.notify_all()
+
+    def replies(self, chat_id):
+        """Очередь (время, текст) сообщений, отправленных ботом в чат."""
+        queue = self._replies.get(chat_id)
+        if queue is None:
+            queue = self._replies[chat_id] = asyncio.Queue()
+        return queue
+
+    def add_voice(self, file_id, data):
+        self._files[file_id] = data
+
+    # --- HTTP ---
+
+    async def _handle_connection(self, reader, writer):
+        self._connections[writer] = asyncio.current_task()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                method, target, _ = line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    header = await reader.readline()
+                    if header in (b'\r\n', b'\n', b''):
+                        break
+                    name, value = header.decode('latin-1').split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+                body = b''
+                if 'content-length' in headers:
+                    body = await reader.readexactly(int(headers['content-length']))
+                elif headers.get('transfer-encoding', '').lower() == 'chunked':
+                    body = await self._read_chunked(reader)
+                await self._dispatch(Request(method, target, headers, body), writer)
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._connections.pop(writer, None)
+            writer.close()
+
+    @staticmethod
+    async def _read_chunked(reader):
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if not size:
+                await reader.readline()
+                return b''.join(chunks)
+            chunks.append(await reader.readexactly(size))
+            await reader.readline()
+
+    @staticmethod
+    def _head(status, content_type, extra=None):
+        lines = [f"HTTP/1.1 {status} {STATUS_TEXT.get(status, 'OK')}", f"Content-Type: {content_type}"]
+        lines.extend(f"{name}: {value}" for name, value in (extra or {}).items())
+        return lines
+
+    async def _respond(self, writer, status, body, content_type='application/json', extra=None):
+        if not isinstance(body, bytes):
+            body = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        head = self._head(status, content_type, extra) + [f"Content-Length: {len(body)}"]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode('latin-1') + body)
+        await writer.drain()
+
+    async def _dispatch(self, request, writer):
+        path = request.path
+        if path.startswith('/bot'):
+            method = path.rsplit('/', 1)[-1]
+            await self._telegram(method, request.form(), writer)
+        elif path.startswith('/file/bot'):
+            file_id = path.rsplit('/', 1)[-1].split('.')[0]
+            data = self._files.get(file_id)
+            await self._respond(writer, 200 if data else 404, data or b'', 'application/octet-stream')
+        elif path.endswith('/chat/completions'):
+            await self._chat_completion(json.loads(request.body), writer)
+        elif path.endswith('/audio/transcriptions'):
+            await self._transcription(request.body, writer)
+        else:
+            await self._respond(writer, 404, {'error': f'unknown path {path}'})
+
+    # --- Telegram Bot API ---
+
+    def _bot_message(self, chat_id, text, message_id=None):
+        if message_id is None:
+            self._message_id += 1
+            message_id = self._message_id
+        return {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'},
+            'text': text,
+        }
+
+    async def _telegram(self, method, params, writer):
+        if method == 'getUpdates':
+            result = await self._get_updates(int(params.get('offset', 0) or 0), float(params.get('timeout', 0) or 0))
+        elif method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot',
+                      'can_join_groups': False, 'can_read_all_group_messages': False,
+                      'supports_inline_queries': False}
+        elif method in ('sendMessage', 'editMessageText'):
+            if self.telegram_latency:
+                await asyncio.sleep(self.telegram_latency)
+            chat_id = int(params['chat_id'])
+            message_id = int(params['message_id']) if method == 'editMessageText' else None
+            result = self._bot_message(chat_id, params.get('text', ''), message_id)
+            if method == 'sendMessage':
+                self.counters['send_message'] += 1
+                self.replies(chat_id).put_nowait((time.perf_counter(), result['text']))
+            else:
+                self.counters['edit_message'] += 1
+        elif method == 'sendChatAction':
+            self.counters['chat_action'] += 1
+            result = True
+        elif method == 'getFile':
+            self.counters['get_file'] += 1
+            file_id = params['file_id']
+            result = {'file_id': file_id, 'file_unique_id': f"u{file_id}",
+                      'file_size': len(self._files.get(file_id, b'')), 'file_path': f"voice/{file_id}.oga"}
+        else:
+            # deleteWebhook, setMyCommands и прочее считаем успешным
+            result = True
+        await self._respond(writer, 200, {'ok': True, 'result': result})
+
+    async def _get_updates(self, offset, timeout):
+        self.polling_started.set()
+        deadline = time.monotonic() + timeout
+        async with self._updates_changed:
+            while True:
+                # Подтвержденные апдейты (update_id < offset) больше не отдаются
+                self._updates = [u for u in self._updates if u['update_id'] >= offset]
+                remaining = deadline - time.monotonic()
+                if self._updates or remaining <= 0 or self._closing:
+                    return list(self._updates[:100])
+                try:
+                    await asyncio.wait_for(self._updates_changed.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+
+    # --- OpenAI ---
+
+    def _rate_limited(self):
+        return self.rate_limit_ratio and self.random.random() < self.rate_limit_ratio
+
+    async def _rate_limit_response(self, writer):
+        self.counters['rate_limited'] += 1
+        await self._respond(writer, 429, {'error': {
+            'message': 'Rate limit reached (bench)', 'type': 'requests', 'param': None,
+            'code': 'rate_limit_exceeded'}}, extra={'retry-after': f"{self.retry_after:g}"})
+
+    async def _chat_completion(self, payload, writer):
+        self.counters['chat_requests'] += 1
+        if self._rate_limited():
+            await self._rate_limit_response(writer)
+            return
+        last_user = next((m['content'] for m in reversed(payload['messages']) if m['role'] == 'user'), '')
+        lang = 'ky' if KY_LETTERS & set(str(last_user).lower()) else 'ru'
+        answer = FAKE_ANSWERS[lang]
+        prompt_tokens = sum(len(str(m.get('content', ''))) for m in payload['messages']) // 3 + 1
+        created = int(time.time())
+        model = payload.get('model', 'gpt-4o')
+
+        self.chat_in_flight += 1
+        self.max_chat_in_flight = max(self.max_chat_in_flight, self.chat_in_flight)
+        try:
+            await asyncio.sleep(max(0.0, self.chat_latency + self.random.uniform(-1, 1) * self.chat_jitter))
+            if not payload.get('stream'):
+                await self._respond(writer, 200, {
+                    'id': f"chatcmpl-bench{created}", 'object': 'chat.completion', 'created': created,
+                    'model': model,
+                    'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': answer},
+                                 'finish_reason': 'stop'}],
+                    'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': len(answer) // 3,
+                              'total_tokens': prompt_tokens + len(answer) // 3},
+                })
+                return
+            self.counters['chat_streams'] += 1
+            await self._stream_answer(writer, answer, created, model)
+        finally:
+            self.chat_in_flight -= 1
+
+    async def _stream_answer(self, writer, answer, created, model):
+        head = self._head(200, 'text/event-stream', {'Transfer-Encoding': 'chunked'})
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode('latin-1'))
+
+        def chunk(delta, finish_reason=None):
+            event = {'id': f"chatcmpl-bench{created}", 'object': 'chat.completion.chunk', 'created': created,
+                     'model': model, 'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]}
+            return f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+        async def send(text):
+            data = text.encode('utf-8')
+            writer.write(f"{len(data):x}\r\n".encode('latin-1') + data + b"\r\n")
+            await writer.drain()
+
+        await send(chunk({'role': 'assistant', 'content': ''}))
+        words = answer.split(' ')
+        for start in range(0, len(words), self.stream_chunk_words):
+            piece = ' '.join(words[start:start + self.stream_chunk_words])
+            await send(chunk({'content': piece if not start else ' ' + piece}))
+            await asyncio.sleep(self.stream_chunk_delay)
+        await send(chunk({}, 'stop'))
+        await send("data: [DONE]\n\n")
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    async def _transcription(self, body, writer):
+        self.counters['transcriptions'] += 1
+        if self._rate_limited():
+            await self._rate_limit_response(writer)
+            return
+        await asyncio.sleep(max(0.0, self.whisper_latency))
+        match = VOICE_MARKER.search(body)
+        text = match.group(1) if match else b''
+        await self._respond(writer, 200, text + b"\n", 'text/plain; charset=utf-8')
+
+    def stats(self):
+        return {**self.counters, 'max_chat_in_flight': self.max_chat_in_flight}
@@ -0,0 +1,99 @@
+"""Точность и скорость определения языка на размеченном корпусе.
+
+Сравнивает language_detector с прежней проверкой подстрок (legacy_detect_language):
+точность по языкам, ошибочные примеры, время одного вызова и число лишних
+переключений языка за диалог при посообщенном определении и с LanguageState.
+
+Запуск:
+    python bench/language_benchmark.py
+    python bench/language_benchmark.py --corpus corpus.json --repeat 2000
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA = os.path.join(ROOT, 'bench', 'data')
+sys.path.insert(0, ROOT)
+
+from language_detector import LanguageState, detect_language, language_score  # noqa: E402
+
+LEGACY_KEYWORDS = [
+    'ооба', 'жок', 'салам', 'жазылайын', 'катталуу', 'тиркеме', 'кабыл алуу', 'кантип', 'эмне',
+    'ким', 'бекенд', 'фронтенд', 'графолог', 'мобилография', 'орт', 'программист', 'баасы', 'узактыгы', 'графиги'
+]
+
+
+def legacy_detect_language(text):
+    """Определение языка до language_detector: буквы ңөү и подстроки ключевых слов."""
+    text_lower = text.lower()
+    if any(char in text_lower for char in "ңөү"):
+        return 'ky'
+    if any(keyword in text_lower for keyword in LEGACY_KEYWORDS) or "саламатсызбы" in text_lower:
+        return 'ky'
+    return 'ru'
+
+
+def evaluate(name, detect, corpus):
+    errors = [(lang, text) for lang, texts in corpus.items() for text in texts if detect(text) != lang]
+    total = sum(len(texts) for texts in corpus.values())
+    per_lang = ", ".join(
+        f"{lang} {sum(1 for text in texts if detect(text) == lang)}/{len(texts)}" for lang, texts in corpus.items())
+    print(f"{name}: точность {(total - len(errors)) / total:.1%} ({per_lang})")
+    for lang, text in errors:
+        print(f"    ожидался {lang}: {text}")
+
+
+def flips(languages):
+    return sum(1 for previous, current in zip(languages, languages[1:]) if previous != current)
+
+
+def dialog_flips(dialogs, mixed_in):
+    """Переключения языка в диалогах, в которые вставлена одна реплика на другом языке."""
+    plain = stateful = 0
+    for lang, dialog in dialogs:
+        intruder = mixed_in['ru' if lang == 'ky' else 'ky']
+        turns = dialog[:2] + [intruder] + dialog[2:]
+        plain += flips([detect_language(text) for text in turns])
+        state = LanguageState.from_first_message(turns[0])
+        languages = [state.lang]
+        for text in turns[1:]:
+            state.observe(text)
+            languages.append(state.lang)
+        stateful += flips(languages)
+    return plain, stateful
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--corpus', default=os.path.join(DATA, 'language_corpus.json'))
+    parser.add_argument('--conversations', default=os.path.join(DATA, 'conversations.json'))
+    parser.add_argument('--repeat', type=int, default=1000, help='повторов корпуса при замере времени')
+    args = parser.parse_args()
+
+    with open(args.corpus, encoding='utf-8') as f:
+        corpus = json.load(f)
+    texts = [text for items in corpus.values() for text in items]
+
+    evaluate("language_detector", detect_language, corpus)
+    evaluate("прежняя проверка подстрок", legacy_detect_language, corpus)
+
+    margins = sorted(abs(language_score(text)) for text in texts)
+    print(f"Уверенность |score|: минимум {margins[0]:.2f}, медиана {margins[len(margins) // 2]:.2f}")
+
+    for name, detect in (("language_detector", detect_language), ("прежняя проверка", legacy_detect_language)):
+        seconds = timeit.timeit(lambda: [detect(text) for text in texts], number=args.repeat)
+        print(f"{name}: {seconds / (args.repeat * len(texts)) * 1e6:.1f} мкс на сообщение")
+
+    with open(args.conversations, encoding='utf-8') as f:
+        conversations = json.load(f)
+    dialogs = [(lang, dialog) for lang, items in conversations.items() for dialog in items]
+    plain, stateful = dialog_flips(dialogs, {'ru': "Сколько стоит?", 'ky': "Канча турат?"})
+    print(f"Диалогов: {len(dialogs)}, в каждый вставлена одна реплика на другом языке")
+    print(f"Переключений языка: по одному сообщению {plain}, с LanguageState {stateful}")
+
+
+if __name__ == '__main__':
+    main()
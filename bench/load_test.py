@@ -0,0 +1,271 @@
+"""Нагрузочный тест бота на локальных заглушках, без сети и учетных данных.
+
+Поднимает заглушки Telegram и OpenAI (bench/fake_services.py), запускает бота
+в отдельном процессе (bench/run_bot_offline.py) и проигрывает синтетические
+диалоги на русском и кыргызском из bench/data/conversations.json: каждый
+пользователь отправляет /start, затем реплики диалога текстом или голосом и
+ждет ответа перед следующей репликой.
+
+Отчет: сообщений в секунду, задержка до первого ответа бота (p50/p95/p99/max),
+пиковый RSS процесса бота и процессорное время на сообщение (по /proc, Linux).
+Ответ с текстом ошибки бота (нет связи с OpenAI, 429, таймаут) считается
+ошибкой, а не ответом.
+
+Запуск:
+    python bench/load_test.py
+    python bench/load_test.py --users 200 --rounds 2 --voice-ratio 0.3 --stream --rate-limit-ratio 0.05
+    python bench/load_test.py --chat-latency 2 --bot-env MESSAGE_DEBOUNCE_SECONDS=0.5 --bot-env OPENAI_RPM_LIMIT=100
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA = os.path.join(ROOT, 'bench', 'data')
+
+# Тексты ошибок берем из самого бота; ему при импорте нужны токены, сеть не используется
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:BENCH")
+os.environ.setdefault("OPENAI_API_KEY", "sk-bench")
+os.environ.setdefault("LOG_FILE", os.path.join(tempfile.mkdtemp(prefix='bot-bench-'), 'loader.log'))
+sys.path.insert(0, ROOT)
+
+from fake_services import FakeServices, voice_payload  # noqa: E402
+from telegram_bot import ERROR_RESPONSES  # noqa: E402
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+
+def process_cpu_seconds(pid):
+    """user + system время процесса из /proc/<pid>/stat."""
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+
+def process_rss_bytes(pid):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(q * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+
+class LoadTest:
+    def __init__(self, args, services, conversations):
+        self.args = args
+        self.services = services
+        self.conversations = conversations
+        self.random = random.Random(args.seed)
+        self.message_id = 0
+        self.latencies = []
+        self.voice_latencies = []
+        self.timeouts = 0
+        self.errors = 0
+        self.sent = 0
+
+    def _message(self, user_id, lang, **content):
+        self.message_id += 1
+        user = {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}", 'language_code': lang}
+        return {'message': {
+            'message_id': self.message_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private', 'first_name': user['first_name']},
+            'from': user,
+            **content,
+        }}
+
+    async def _exchange(self, user_id, update, voice=False):
+        """Отправляет апдейт и ждет первого сообщения бота в этот чат."""
+        replies = self.services.replies(user_id)
+        # Запоздавшие ответы на прошлые реплики не засчитываются следующей
+        while not replies.empty():
+            replies.get_nowait()
+        started = time.perf_counter()
+        await self.services.push_update(update)
+        self.sent += 1
+        try:
+            received, text = await asyncio.wait_for(replies.get(), self.args.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            return
+        if text in ERROR_RESPONSES:
+            self.errors += 1
+            return
+        (self.voice_latencies if voice else self.latencies).append(received - started)
+
+    async def _user(self, index):
+        user_id = 100000 + index
+        lang = 'ky' if self.random.random() < self.args.ky_ratio else 'ru'
+        await self._exchange(user_id, self._message(
+            user_id, lang, text='/start', entities=[{'type': 'bot_command', 'offset': 0, 'length': 6}]))
+        for round_number in range(self.args.rounds):
+            for turn, text in enumerate(self.random.choice(self.conversations[lang])):
+                if self.args.think_time:
+                    await asyncio.sleep(self.random.expovariate(1 / self.args.think_time))
+                if self.random.random() < self.args.voice_ratio:
+                    file_id = f"voice{user_id}r{round_number}t{turn}"
+                    data = voice_payload(text)
+                    self.services.add_voice(file_id, data)
+                    voice = {'file_id': file_id, 'file_unique_id': f"u{file_id}", 'duration': 3,
+                             'mime_type': 'audio/ogg', 'file_size': len(data)}
+                    await self._exchange(user_id, self._message(user_id, lang, voice=voice), voice=True)
+                else:
+                    await self._exchange(user_id, self._message(user_id, lang, text=text))
+
+    async def run(self):
+        semaphore = asyncio.Semaphore(self.args.concurrency or self.args.users)
+
+        async def limited(index):
+            async with semaphore:
+                await self._user(index)
+
+        await asyncio.gather(*(limited(i) for i in range(self.args.users)))
+
+
+async def sample_rss(pid, peak, stop):
+    while not stop.is_set():
+        try:
+            peak[0] = max(peak[0], process_rss_bytes(pid))
+        except OSError:
+            return
+        try:
+            await asyncio.wait_for(stop.wait(), 0.2)
+        except asyncio.TimeoutError:
+            pass
+
+
+def format_latencies(values):
+    values = sorted(values)
+    if not values:
+        return "нет данных"
+    parts = [f"p{int(q * 100)} {percentile(values, q) * 1000:.0f}" for q in (0.5, 0.95, 0.99)]
+    return f"n={len(values)}, " + ", ".join(parts) + f", max {values[-1] * 1000:.0f} мс"
+
+
+async def run(args):
+    with open(args.conversations, encoding='utf-8') as f:
+        conversations = json.load(f)
+    services = await FakeServices(
+        chat_latency=args.chat_latency, chat_jitter=args.chat_jitter, stream_chunk_delay=args.stream_chunk_delay,
+        whisper_latency=args.whisper_latency, rate_limit_ratio=args.rate_limit_ratio,
+        retry_after=args.retry_after, telegram_latency=args.telegram_latency, seed=args.seed,
+    ).start()
+
+    workdir = tempfile.mkdtemp(prefix='bot-bench-')
+    env = dict(os.environ)
+    env.update({
+        'TELEGRAM_API_BASE_URL': services.base_url,
+        'OPENAI_BASE_URL': f"{services.base_url}/v1",
+        'CACHE_SNAPSHOT_PATH': os.path.join(workdir, 'cache_snapshot.json.gz'),
+        'LOG_FILE': os.path.join(workdir, 'bot.log'),
+        'STREAM_REPLIES': 'true' if args.stream else 'false',
+        'PYTHONUNBUFFERED': '1',
+    })
+    for item in args.bot_env:
+        key, _, value = item.partition('=')
+        env[key] = value
+    output_path = os.path.join(workdir, 'stdout.log')
+    with open(output_path, 'wb') as output:
+        bot = subprocess.Popen([sys.executable, os.path.join(ROOT, 'bench', 'run_bot_offline.py')],
+                               cwd=ROOT, env=env, stdout=output, stderr=subprocess.STDOUT)
+    try:
+        startup = time.perf_counter()
+        try:
+            await asyncio.wait_for(services.polling_started.wait(), args.startup_timeout)
+        except asyncio.TimeoutError:
+            sys.exit(f"Бот не начал опрос getUpdates за {args.startup_timeout} с, см. {output_path}")
+        startup = time.perf_counter() - startup
+
+        test = LoadTest(args, services, conversations)
+        peak_rss, stop = [process_rss_bytes(bot.pid)], asyncio.Event()
+        sampler = asyncio.create_task(sample_rss(bot.pid, peak_rss, stop))
+        cpu_before = process_cpu_seconds(bot.pid)
+        started = time.perf_counter()
+        await test.run()
+        elapsed = time.perf_counter() - started
+        cpu = process_cpu_seconds(bot.pid) - cpu_before
+        stop.set()
+        await sampler
+    finally:
+        bot.send_signal(signal.SIGINT)
+        try:
+            bot.wait(10)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+        await services.stop()
+
+    answered = len(test.latencies) + len(test.voice_latencies)
+    report = {
+        'users': args.users,
+        'messages': test.sent,
+        'answered': answered,
+        'timeouts': test.timeouts,
+        'errors': test.errors,
+        'seconds': round(elapsed, 2),
+        'messages_per_second': round(answered / elapsed, 2) if elapsed else 0.0,
+        'startup_seconds': round(startup, 2),
+        'text_latency_ms': {f"p{int(q * 100)}": round(percentile(sorted(test.latencies), q) * 1000)
+                            for q in (0.5, 0.95, 0.99)},
+        'voice_latency_ms': {f"p{int(q * 100)}": round(percentile(sorted(test.voice_latencies), q) * 1000)
+                             for q in (0.5, 0.95, 0.99)},
+        'peak_rss_mb': round(peak_rss[0] / 2 ** 20, 1),
+        'cpu_ms_per_message': round(cpu * 1000 / answered, 2) if answered else 0.0,
+        'fake_services': services.stats(),
+        'workdir': workdir,
+    }
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return
+    print(f"Пользователей: {args.users}, сообщений: {test.sent}, отвечено: {answered}, "
+          f"ошибок: {test.errors}, таймаутов: {test.timeouts}")
+    print(f"Время: {elapsed:.2f} с, {report['messages_per_second']} сообщ./с, запуск бота {startup:.2f} с")
+    print(f"Текст:  {format_latencies(test.latencies)}")
+    print(f"Голос:  {format_latencies(test.voice_latencies)}")
+    print(f"Пиковый RSS: {report['peak_rss_mb']} МБ, CPU на сообщение: {report['cpu_ms_per_message']} мс")
+    print("Заглушки: " + ", ".join(f"{name}={value}" for name, value in services.stats().items()))
+    print(f"Логи бота: {workdir}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=50, help='число пользователей (чатов)')
+    parser.add_argument('--concurrency', type=int, default=0,
+                        help='сколько пользователей ведут диалог одновременно (0 — все сразу)')
+    parser.add_argument('--rounds', type=int, default=1, help='сколько диалогов проигрывает каждый пользователь')
+    parser.add_argument('--ky-ratio', type=float, default=0.5, help='доля пользователей на кыргызском')
+    parser.add_argument('--voice-ratio', type=float, default=0.2, help='доля реплик голосом')
+    parser.add_argument('--think-time', type=float, default=0.0, help='средняя пауза между репликами, с')
+    parser.add_argument('--timeout', type=float, default=60.0, help='сколько ждать ответа бота, с')
+    parser.add_argument('--stream', action='store_true', help='включить STREAM_REPLIES в боте')
+    parser.add_argument('--chat-latency', type=float, default=0.8, help='задержка ответа OpenAI chat, с')
+    parser.add_argument('--chat-jitter', type=float, default=0.3, help='разброс задержки chat, с')
+    parser.add_argument('--stream-chunk-delay', type=float, default=0.05, help='пауза между чанками потока, с')
+    parser.add_argument('--whisper-latency', type=float, default=0.6, help='задержка расшифровки, с')
+    parser.add_argument('--rate-limit-ratio', type=float, default=0.0, help='доля запросов OpenAI с ответом 429')
+    parser.add_argument('--retry-after', type=float, default=1.0, help='Retry-After в ответах 429, с')
+    parser.add_argument('--telegram-latency', type=float, default=0.0, help='задержка sendMessage, с')
+    parser.add_argument('--bot-env', action='append', default=[], metavar='KEY=VALUE',
+                        help='переменная окружения для процесса бота (можно повторять)')
+    parser.add_argument('--conversations', default=os.path.join(DATA, 'conversations.json'))
+    parser.add_argument('--startup-timeout', type=float, default=60.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='вывести отчет в JSON')
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
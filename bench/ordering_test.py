@@ -0,0 +1,124 @@
+"""Проверка порядка ответов внутри чата: текст и голосовые не обгоняют друг друга.
+
+1. ChatDispatcher: T1 (обрабатывается), T2 (ждет в пачке), V3 (голосовое), T4 —
+   должны обработаться как T1, T2, V3, T4; T4 не присоединяется к пачке T2.
+2. Настоящие обработчики бота на локальных заглушках (bench/fake_services.py):
+   голосовое, а сразу за ним текст — в память диалога реплики попадают в том
+   же порядке, хотя расшифровка голосового идет дольше.
+
+Запуск (из корня репозитория, чтобы нашлись system_prompt_*.txt):
+    python bench/ordering_test.py
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:BENCH")
+os.environ.setdefault("OPENAI_API_KEY", "sk-bench")
+WORKDIR = tempfile.mkdtemp(prefix='bot-ordering-')
+os.environ.setdefault("LOG_FILE", os.path.join(WORKDIR, 'bot.log'))
+os.environ.setdefault("CACHE_SNAPSHOT_PATH", os.path.join(WORKDIR, 'cache_snapshot.json.gz'))
+
+from telegram import Update  # noqa: E402
+
+from chat_dispatcher import ChatDispatcher  # noqa: E402
+from fake_google import FakeDocsService, FakeSheetsClient  # noqa: E402
+from fake_services import FakeServices, voice_payload  # noqa: E402
+import telegram_bot  # noqa: E402
+
+failures = []
+
+
+def check(name, condition, details=""):
+    print(f"{'OK  ' if condition else 'FAIL'} {name}{': ' + details if details and not condition else ''}")
+    if not condition:
+        failures.append(name)
+
+
+async def check_dispatcher():
+    dispatcher = ChatDispatcher()
+    processed = []
+
+    async def process(batch):
+        await asyncio.sleep(0.05)
+        processed.append("+".join(batch))
+
+    async def voice():
+        async with dispatcher.serialized('chat'):
+            processed.append('V3')
+
+    t1 = asyncio.create_task(dispatcher.submit('chat', 'T1', process))
+    await asyncio.sleep(0.01)
+    t2 = asyncio.create_task(dispatcher.submit('chat', 'T2', process))
+    await asyncio.sleep(0.01)
+    v3 = asyncio.create_task(voice())
+    await asyncio.sleep(0.01)
+    t4 = asyncio.create_task(dispatcher.submit('chat', 'T4', process))
+    await asyncio.gather(t1, t2, v3, t4)
+    check("диспетчер: текст после голосового не присоединяется к пачке перед ним",
+          processed == ['T1', 'T2', 'V3', 'T4'], str(processed))
+
+
+def make_update(bot, message_id, **content):
+    user = {'id': 4242, 'is_bot': False, 'first_name': 'Order', 'language_code': 'ru'}
+    return Update.de_json({'update_id': message_id, 'message': {
+        'message_id': message_id,
+        'date': int(time.time()),
+        'chat': {'id': user['id'], 'type': 'private', 'first_name': user['first_name']},
+        'from': user,
+        **content,
+    }}, bot)
+
+
+async def check_handlers():
+    # Расшифровка заметно дольше ответа на текст: без очереди текст ответился бы первым
+    services = await FakeServices(chat_latency=0.05, chat_jitter=0, whisper_latency=0.3, seed=1).start()
+    telegram_bot.TELEGRAM_API_BASE_URL = services.base_url
+    telegram_bot.OPENAI_BASE_URL = f"{services.base_url}/v1"
+    telegram_bot.init_openai_client()
+    telegram_bot.init_google_clients(sheets=FakeSheetsClient(latency=0), docs=FakeDocsService(latency=0))
+    telegram_bot.refresh_coordinator.refresh_sync()
+    bot = telegram_bot.create_bot()
+    try:
+        async with bot:
+            context = types.SimpleNamespace(bot=bot, user_data={})
+            data = voice_payload("голосовой вопрос")
+            services.add_voice('order-voice', data)
+            voice_update = make_update(bot, 1, voice={
+                'file_id': 'order-voice', 'file_unique_id': 'uorder-voice', 'duration': 2,
+                'mime_type': 'audio/ogg', 'file_size': len(data)})
+            text_update = make_update(bot, 2, text="текст после голосового")
+
+            voice = asyncio.create_task(telegram_bot.handle_voice_message(voice_update, context))
+            # Голосовой обработчик доходит до первого await, и только потом приходит текст
+            await asyncio.sleep(0)
+            text = asyncio.create_task(telegram_bot.handle_text_message(text_update, context))
+            await asyncio.gather(voice, text)
+
+            turns = [text for role, text, _ in telegram_bot.get_memory(context.user_data).turns if role == 'user']
+            check("обработчики: голосовое отвечено раньше текста, отправленного после него",
+                  turns == ["голосовой вопрос", "текст после голосового"], str(turns))
+    finally:
+        await telegram_bot.openai_client.close()
+        await services.stop()
+
+
+async def run():
+    await check_dispatcher()
+    await check_handlers()
+
+
+def main():
+    os.chdir(ROOT)
+    asyncio.run(run())
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
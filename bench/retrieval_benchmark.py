@@ -0,0 +1,91 @@
+"""Офлайн-сравнение полного промпта и промпта с поиском по базе знаний.
+
+Промпты собирает сам бот (telegram_bot.get_retrieval_prompt и get_cached_prompt)
+на данных из bench/data. Для каждого вопроса считается размер контекста — части
+промпта после неизменяемого префикса (база знаний и курсы), — и покрытие: доля
+ожидаемых фактов, оказавшихся в контексте.
+
+Запуск:
+    python bench/retrieval_benchmark.py
+    python bench/retrieval_benchmark.py --kb kb.txt --courses courses.json --questions q.json --top-k 4
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA = os.path.join(ROOT, 'bench', 'data')
+sys.path.insert(0, ROOT)
+
+# Модулю бота при импорте нужны токены и файл лога; сеть не используется
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:BENCH")
+os.environ.setdefault("OPENAI_API_KEY", "sk-bench")
+os.environ.setdefault("LOG_FILE", os.path.join(tempfile.mkdtemp(prefix='bot-retrieval-'), 'bot.log'))
+
+import telegram_bot  # noqa: E402
+
+# Логи бота о загрузке данных перемешались бы с таблицей результатов
+logging.disable(logging.ERROR)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--lang', default='ru')
+    parser.add_argument('--kb', default=os.path.join(DATA, 'knowledge_base_ru.txt'))
+    parser.add_argument('--courses', default=os.path.join(DATA, 'courses.json'))
+    parser.add_argument('--questions', default=os.path.join(DATA, 'questions_ru.json'))
+    parser.add_argument('--top-k', type=int, default=6)
+    parser.add_argument('--min-score', type=float, default=1.0)
+    parser.add_argument('--chunk-chars', type=int, default=800)
+    args = parser.parse_args()
+
+    with open(args.kb, encoding='utf-8') as f:
+        telegram_bot.knowledge_base_cache[args.lang] = f.read()
+    with open(args.courses, encoding='utf-8') as f:
+        telegram_bot.course_cache[args.lang] = json.load(f).get(args.lang, [])
+    with open(args.questions, encoding='utf-8') as f:
+        questions = json.load(f)
+
+    # Шаблон промпта system_prompt_*.txt ищется относительно текущего каталога
+    os.chdir(ROOT)
+    telegram_bot.RETRIEVAL_TOP_K = args.top_k
+    telegram_bot.RETRIEVAL_MIN_SCORE = args.min_score
+    telegram_bot.RETRIEVAL_CHUNK_CHARS = args.chunk_chars
+    telegram_bot.rebuild_prompt_cache()
+    telegram_bot.rebuild_retrieval_index()
+    cached = telegram_bot.get_cached_prompt(args.lang)
+    full_context = cached['text'][len(cached['prefix']):]
+
+    total_full = total_retrieved = 0
+    covered = expected_total = fallbacks = 0
+    print(f"{'вопрос':<45} {'полный':>8} {'поиск':>8} покрытие")
+    for item in questions:
+        prompt = telegram_bot.get_retrieval_prompt(args.lang, item['question'])
+        if prompt is not None:
+            context = prompt[len(cached['prefix']):]
+        else:
+            # Бот в этом случае отправляет полный промпт
+            context = full_context
+            fallbacks += 1
+        found = sum(1 for fact in item['expected'] if fact in context)
+        covered += found
+        expected_total += len(item['expected'])
+        total_full += len(full_context)
+        total_retrieved += len(context)
+        print(f"{item['question'][:45]:<45} {len(full_context):>8} {len(context):>8} "
+              f"{found}/{len(item['expected'])}")
+
+    print()
+    print(f"Фрагментов в индексе: {len(telegram_bot.retrieval_index[args.lang].chunks)}")
+    print(f"Средний размер контекста: полный {total_full / len(questions):.0f} символов, "
+          f"с поиском {total_retrieved / len(questions):.0f} символов "
+          f"({100 * total_retrieved / total_full:.0f}%)")
+    print(f"Покрытие ожидаемых фактов: {covered}/{expected_total} "
+          f"({100 * covered / expected_total:.0f}%), откатов на полный документ: {fallbacks}")
+
+
+if __name__ == '__main__':
+    main()
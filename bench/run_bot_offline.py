@@ -0,0 +1,35 @@
+"""Запуск бота без учетных данных: Google подменяется заглушками из bench/fake_google.py.
+
+Telegram и OpenAI направляются на локальные заглушки переменными окружения
+TELEGRAM_API_BASE_URL и OPENAI_BASE_URL (их выставляет bench/load_test.py).
+
+Запуск (из корня репозитория, чтобы нашлись system_prompt_*.txt):
+    TELEGRAM_API_BASE_URL=http://127.0.0.1:8081 OPENAI_BASE_URL=http://127.0.0.1:8081/v1 \\
+        python bench/run_bot_offline.py
+"""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Фиктивные ключи: настоящие сервисы не вызываются
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:BENCH")
+os.environ.setdefault("OPENAI_API_KEY", "sk-bench")
+os.environ.setdefault("DOC_ID", "bench-doc")
+
+from fake_google import FakeDocsService, FakeSheetsClient  # noqa: E402
+import telegram_bot  # noqa: E402
+
+
+def main():
+    google_latency = float(os.getenv("BENCH_GOOGLE_LATENCY", "0.2"))
+    telegram_bot.init_clients(
+        sheets=FakeSheetsClient(latency=google_latency),
+        docs=FakeDocsService(latency=google_latency),
+    )
+    telegram_bot.main()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""Дымовой тест ответов GPT через локальную заглушку OpenAI (bench/fake_services.py).
+
+Проверяет обычный ответ (get_gpt_response) и потоковый (stream_gpt_response):
+оба должны вернуть текст заглушки, а не сообщение об ошибке, а потоковый еще
+и отправить сообщение и довести его правками до финального текста без курсора.
+Сбой сети Telegram посреди потока не должен превращать ответ в ошибку OpenAI.
+
+Запуск (из корня репозитория, чтобы нашлись system_prompt_*.txt):
+    python bench/smoke_test.py
+"""
+import asyncio
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:BENCH")
+os.environ.setdefault("OPENAI_API_KEY", "sk-bench")
+WORKDIR = tempfile.mkdtemp(prefix='bot-smoke-')
+os.environ.setdefault("LOG_FILE", os.path.join(WORKDIR, 'bot.log'))
+os.environ.setdefault("CACHE_SNAPSHOT_PATH", os.path.join(WORKDIR, 'cache_snapshot.json.gz'))
+
+from telegram.error import NetworkError  # noqa: E402
+
+from fake_google import FakeDocsService, FakeSheetsClient  # noqa: E402
+from fake_services import FAKE_ANSWERS, FakeServices  # noqa: E402
+import telegram_bot  # noqa: E402
+
+
+class FakeReply:
+    def __init__(self, text):
+        self.text = text
+        self.edits = []
+
+    async def edit_text(self, text):
+        self.text = text
+        self.edits.append(text)
+
+
+class FakeMessage:
+    """Сообщение пользователя: запоминает ответы бота вместо отправки в Telegram.
+
+    failures — сколько первых отправок завершится ошибкой сети Telegram.
+    """
+
+    def __init__(self, failures=0):
+        self.replies = []
+        self.failures = failures
+
+    async def reply_text(self, text):
+        if self.failures:
+            self.failures -= 1
+            raise NetworkError("Bad Gateway")
+        reply = FakeReply(text)
+        self.replies.append(reply)
+        return reply
+
+
+async def run():
+    services = await FakeServices(chat_latency=0.05, chat_jitter=0, stream_chunk_delay=0.01, seed=1).start()
+    telegram_bot.OPENAI_BASE_URL = f"{services.base_url}/v1"
+    telegram_bot.init_openai_client()
+    telegram_bot.init_google_clients(sheets=FakeSheetsClient(latency=0), docs=FakeDocsService(latency=0))
+    telegram_bot.refresh_coordinator.refresh_sync()
+    # Правки потока без пауз, чтобы проверить и промежуточные правки
+    telegram_bot.STREAM_EDIT_INTERVAL = 0
+    failures = []
+
+    def check(name, condition, details=""):
+        print(f"{'OK  ' if condition else 'FAIL'} {name}{': ' + details if details and not condition else ''}")
+        if not condition:
+            failures.append(name)
+
+    try:
+        text = await telegram_bot.get_gpt_response("Сколько стоит Python?", [], 'ru')
+        check("обычный ответ", text == FAKE_ANSWERS['ru'], text)
+
+        message = FakeMessage()
+        text = await telegram_bot.stream_gpt_response(message, "Python сабактары качан өтөт?", [], 'ky')
+        check("потоковый ответ", text == FAKE_ANSWERS['ky'], text)
+        check("потоковый ответ отправлен одним сообщением", len(message.replies) == 1)
+        if message.replies:
+            reply = message.replies[0]
+            check("промежуточные правки", len(reply.edits) > 1, str(len(reply.edits)))
+            check("финальный текст без курсора", reply.text == FAKE_ANSWERS['ky'], reply.text)
+        check("запрос шел потоком", services.stats()['chat_streams'] == 1)
+
+        message = FakeMessage(failures=1)
+        text = await telegram_bot.stream_gpt_response(message, "Python сабактары качан өтөт?", [], 'ky')
+        check("сбой Telegram посреди потока: ответ не заменен ошибкой", text == FAKE_ANSWERS['ky'], text)
+        check("сбой Telegram посреди потока: ответ отправлен целиком",
+              [reply.text for reply in message.replies] == [FAKE_ANSWERS['ky']],
+              str([reply.text for reply in message.replies]))
+    finally:
+        await telegram_bot.openai_client.close()
+        await services.stop()
+    return failures
+
+
+def main():
+    os.chdir(ROOT)
+    failures = asyncio.run(run())
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""Последовательная обработка сообщений внутри одного чата при параллельной обработке разных чатов."""
+import asyncio
+import contextlib
+
+
+class ChatBusy(Exception):
+    """В очереди чата слишком много необработанных сообщений."""
+
+
+class ChatDispatcher:
+    """Порядок реплик внутри чата и склейка быстрых сообщений подряд.
+
+    Обработчики одного чата выполняются строго по очереди под блокировкой чата,
+    обработчики разных чатов — параллельно. Ожидающие блокировку обслуживаются
+    в порядке прихода, поэтому место в очереди занимается при входе в serialized(),
+    до первого await. Текстовые сообщения, пришедшие, пока чат занят предыдущим
+    ответом (и еще debounce секунд, если задано), объединяются в одну пачку и
+    обрабатываются одним вызовом; в свободном чате сообщение обрабатывается сразу.
+    Другой обработчик, вставший в очередь чата (например, голосовое), закрывает
+    собирающуюся пачку: следующие сообщения встанут уже за ним.
+    """
+
+    def __init__(self, debounce=0.0, max_pending=5):
+        self.debounce = debounce
+        self.max_pending = max_pending
+        self._locks = {}
+        self._waiters = {}
+        self._batches = {}
+        self.coalesced = 0
+        self.rejected = 0
+
+    @contextlib.asynccontextmanager
+    async def serialized(self, key, _batch=None):
+        """Выполняет блок под блокировкой чата; лишние ожидающие получают ChatBusy."""
+        waiters = self._waiters.get(key, 0)
+        if waiters >= self.max_pending:
+            self.rejected += 1
+            raise ChatBusy(key)
+        if self._batches.get(key) is not _batch:
+            # Закрываем пачку перед нами: сообщения после нас не должны к ней присоединиться
+            self._batches.pop(key, None)
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        self._waiters[key] = waiters + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                # Блокировки неактивных чатов не копятся в памяти
+                del self._waiters[key]
+                del self._locks[key]
+
+    async def submit(self, key, item, process):
+        """Добавляет сообщение в пачку чата и обрабатывает пачку вызовом process(items).
+
+        Если пачка для чата уже собирается, сообщение просто присоединяется к ней.
+        """
+        batch = self._batches.get(key)
+        if batch is not None:
+            if len(batch) >= self.max_pending:
+                self.rejected += 1
+                raise ChatBusy(key)
+            batch.append(item)
+            self.coalesced += 1
+            return
+        batch = self._batches[key] = [item]
+        try:
+            # Место в очереди занимаем сразу, а debounce выжидаем уже под блокировкой
+            async with self.serialized(key, _batch=batch):
+                if self.debounce > 0:
+                    await asyncio.sleep(self.debounce)
+                # Пачка закрыта, новые сообщения начнут следующую
+                if self._batches.get(key) is batch:
+                    del self._batches[key]
+                await process(batch)
+        finally:
+            # При ошибке или отмене не оставляем пачку, к которой будут вечно присоединяться
+            if self._batches.get(key) is batch:
+                del self._batches[key]
+
+    def stats(self):
+        return {
+            'active_chats': len(self._locks),
+            'waiting': sum(self._waiters.values()),
+            'batching': len(self._batches),
+            'coalesced': self.coalesced,
+            'rejected': self.rejected,
+        }
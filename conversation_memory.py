@@ -0,0 +1,131 @@
+"""Ограниченная по токенам память диалога одного пользователя."""
+import sys
+import time
+from collections import deque
+
+# Грубая оценка: для русского и кыргызского текста один токен ~ 3 символа
+CHARS_PER_TOKEN = 3
+SUMMARY_LABEL = "Краткое содержание предыдущего диалога (вопросы пользователя): "
+SUMMARY_SNIPPET_CHARS = 120
+
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+class ConversationMemory:
+    """История диалога в кольцевом буфере с бюджетом токенов.
+
+    Старые реплики, не помещающиеся в бюджет, вытесняются и сворачиваются
+    в короткое текстовое резюме из вопросов пользователя. Вытесняется вопрос
+    вместе с ответом на него, поэтому история всегда начинается с вопроса.
+    Резюме тоже входит в бюджет: при нехватке из него первыми уходят самые
+    старые вопросы. Последний вопрос с ответом остается в истории всегда.
+    """
+
+    __slots__ = ('turns', 'summary', 'last_active', 'token_budget', 'summary_max_chars', '_tokens')
+
+    def __init__(self, token_budget=1500, max_turns=20, summary_max_chars=600):
+        # Реплики хранятся компактно: (роль, текст, оценка токенов)
+        self.turns = deque(maxlen=max_turns)
+        self.summary = ""
+        self.last_active = time.time()
+        self.token_budget = token_budget
+        self.summary_max_chars = summary_max_chars
+        self._tokens = 0
+
+    def add(self, role, text):
+        if len(self.turns) == self.turns.maxlen:
+            self._evict()
+        tokens = estimate_tokens(text)
+        self.turns.append((role, text, tokens))
+        self._tokens += tokens
+        self._fit_budget()
+        self.touch()
+
+    def _evict(self):
+        """Сворачивает самый старый вопрос вместе с ответами на него."""
+        self._fold(self.turns.popleft())
+        while self.turns and self.turns[0][0] != 'user':
+            self._fold(self.turns.popleft())
+
+    def _fit_budget(self):
+        # Свежие реплики ценнее старых вопросов в резюме: сначала из резюме уходят
+        # все вопросы, кроме последнего, затем реплики (пока в истории есть вопрос
+        # новее первого) и только потом само резюме
+        while self.tokens > self.token_budget:
+            if "; " in self.summary:
+                self.summary = self.summary.split("; ", 1)[1]
+            elif sum(role == 'user' for role, _, _ in self.turns) > 1:
+                self._evict()
+            elif self.summary:
+                self.summary = ""
+            else:
+                break
+
+    def _fold(self, turn):
+        role, text, tokens = turn
+        self._tokens -= tokens
+        if role != 'user':
+            return
+        snippet = " ".join(text.split())[:SUMMARY_SNIPPET_CHARS]
+        summary = f"{self.summary}; {snippet}" if self.summary else snippet
+        if len(summary) > self.summary_max_chars:
+            # Оставляем самые свежие вопросы, обрезая начало по границе записи
+            summary = summary[-self.summary_max_chars:]
+            summary = summary.split("; ", 1)[-1]
+        self.summary = summary
+
+    def touch(self):
+        self.last_active = time.time()
+
+    def clear(self):
+        self.turns.clear()
+        self.summary = ""
+        self._tokens = 0
+        self.touch()
+
+    def is_idle(self, ttl_seconds, now=None):
+        return (now or time.time()) - self.last_active > ttl_seconds
+
+    @property
+    def tokens(self):
+        """Оценка токенов истории в том виде, в каком она уходит в запрос (см. as_messages)."""
+        return self._tokens + (estimate_tokens(SUMMARY_LABEL + self.summary) if self.summary else 0)
+
+    def as_messages(self):
+        """История в формате сообщений OpenAI, с резюме в начале, если оно есть."""
+        messages = []
+        if self.summary:
+            messages.append({"role": "system", "content": SUMMARY_LABEL + self.summary})
+        messages.extend({"role": role, "content": text} for role, text, _ in self.turns)
+        return messages
+
+    def to_dict(self):
+        """Состояние для внешнего хранилища (JSON)."""
+        return {
+            'turns': [[role, text] for role, text, _ in self.turns],
+            'summary': self.summary,
+            'last_active': self.last_active,
+        }
+
+    @classmethod
+    def from_dict(cls, data, **settings):
+        """Восстанавливает память из to_dict(); реплики сверх текущих лимитов сворачиваются в резюме."""
+        memory = cls(**settings)
+        memory.summary = data.get('summary', "")
+        for role, text in data.get('turns', ()):
+            memory.add(role, text)
+        # Снимки старого формата могли начинаться с ответа без вопроса
+        while memory.turns and memory.turns[0][0] != 'user':
+            memory._fold(memory.turns.popleft())
+        memory._fit_budget()
+        memory.last_active = data.get('last_active', memory.last_active)
+        return memory
+
+    def size_bytes(self):
+        """Приблизительный объем памяти, занимаемый историей пользователя."""
+        size = sys.getsizeof(self) + sys.getsizeof(self.turns) + sys.getsizeof(self.summary)
+        for turn in self.turns:
+            size += sys.getsizeof(turn) + sys.getsizeof(turn[1])
+        return size
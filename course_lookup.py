@@ -0,0 +1,95 @@
+"""Быстрый ответ на простые вопросы о курсах прямо из данных Google Sheets.
+
+Вопросы вида "сколько стоит питон?" или "бекенддин графиги кандай?" однозначно
+отвечаются строкой таблицы курсов, поэтому для них не нужен запрос к GPT.
+Быстрый ответ дается только коротким вопросам с одним намерением: каждое слово
+вопроса должно быть названием курса, ключевым словом поля или служебным словом.
+Все остальное ("стоит ли идти", "есть ли скидка") уходит в GPT.
+"""
+import re
+
+# Поле вопроса -> колонка в записи курса (см. load_courses_from_sheets)
+FIELDS = {
+    'price': 'Цена / на месяц',
+    'duration': 'Продолжительность',
+    'schedule': 'график учебы',
+    'age': 'возрастное ограничение',
+}
+
+# Ключевые слова полей на русском и кыргызском (начала слов)
+FIELD_KEYWORDS = {
+    'price': ['цен', 'сколько стои', 'стоимост', 'оплат', 'прайс', 'баас', 'баал', 'төлө', 'канча тур',
+              'канча сом'],
+    'duration': ['длит', 'продолжит', 'срок', 'сколько месяц', 'узакт', 'канча ай'],
+    'schedule': ['график', 'графиг', 'расписан', 'во сколько', 'в какие дни', 'ырааттам', 'качан', 'кайсы күн'],
+    'age': ['возраст', 'скольки лет', 'сколько лет', 'жашт', 'жашк', 'жашы'],
+}
+
+# Слова, которые не меняют смысла простого вопроса о поле курса
+STOPWORDS = {
+    # ru
+    'а', 'и', 'у', 'в', 'на', 'по', 'с', 'со', 'для', 'к', 'о', 'об', 'вас', 'ваш', 'вашего', 'вашему',
+    'какой', 'какая', 'какое', 'какие', 'какого', 'каков', 'какова', 'сколько', 'можно', 'это',
+    'курс', 'курса', 'курсе', 'курсу', 'курсом', 'курсы', 'курсов', 'обучение', 'обучения', 'занятия', 'занятий',
+    'подскажите', 'скажите', 'пожалуйста', 'здравствуйте', 'привет', 'добрый', 'день', 'вечер',
+    # ky
+    'канча', 'кандай', 'кайсы', 'барбы', 'эмне', 'курсун', 'курсунун', 'курстун', 'курсуна',
+    'курстары', 'курстардын', 'окуу', 'окуунун', 'сабак', 'сабактар', 'сабактары', 'салам',
+    'саламатсызбы', 'айтып', 'бериңизчи', 'бериңиз', 'берсеңиз', 'сураныч', 'өтөт', 'болот',
+}
+
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def _prefix_pattern(phrases):
+    """Регулярка, совпадающая с любой фразой в начале слова (с любым окончанием)."""
+    alternatives = sorted((re.escape(p.lower()) for p in phrases), key=len, reverse=True)
+    return re.compile(r"\b(?:" + "|".join(alternatives) + r")\w*", re.UNICODE)
+
+
+FIELD_PATTERNS = {field: _prefix_pattern(keywords) for field, keywords in FIELD_KEYWORDS.items()}
+
+
+class CourseLookup:
+    """Индекс курсов по названиям, синонимам и ключевым словам полей."""
+
+    def __init__(self, courses, synonyms=None, max_words=8):
+        self.courses = list(courses)
+        self.max_words = max_words
+        self._course_patterns = []
+        for course in self.courses:
+            name = course.get('Название курса', '').strip().lower()
+            if not name:
+                continue
+            aliases = {name}
+            for canonical, canonical_aliases in (synonyms or {}).items():
+                if canonical in name or any(alias in name for alias in canonical_aliases):
+                    aliases.add(canonical)
+                    aliases.update(canonical_aliases)
+            self._course_patterns.append((_prefix_pattern(aliases), course))
+
+    def match(self, text):
+        """Возвращает (курс, [поле]) для однозначного вопроса или None."""
+        text = text.lower().replace('ё', 'е')
+        words = list(WORD_RE.finditer(text))
+        if not words or len(words) > self.max_words:
+            return None
+        matched = [(course, spans) for pattern, course in self._course_patterns
+                   if (spans := [m.span() for m in pattern.finditer(text)])]
+        if len(matched) != 1:
+            return None
+        course, covered = matched[0]
+        fields = []
+        for field, pattern in FIELD_PATTERNS.items():
+            spans = [m.span() for m in pattern.finditer(text)]
+            if spans:
+                fields.append(field)
+                covered += spans
+        # Одно намерение: на вопрос о нескольких полях сразу отвечает GPT
+        if len(fields) != 1 or not str(course.get(FIELDS[fields[0]], '')).strip():
+            return None
+        for word in words:
+            start, end = word.span()
+            if word.group() not in STOPWORDS and not any(a <= start and end <= b for a, b in covered):
+                return None
+        return course, fields
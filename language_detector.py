@@ -0,0 +1,201 @@
+"""Определение языка сообщения (русский или кыргызский) и язык ответа пользователю.
+
+language_score() складывает три вида свидетельств в одну оценку: больше нуля —
+кыргызский, меньше — русский, модуль — уверенность:
+    * буквы ң, ө, ү, которых нет в русском;
+    * служебные и частые слова, совпадающие только целым словом
+      (подстрока "орт" внутри "спорт" ничего не значит);
+    * статистика символьных триграмм, обученная на образцах текста ниже.
+Все таблицы и регулярные выражения строятся один раз при импорте модуля.
+
+Оценки по модулю меньше NEUTRAL_BAND ("Ок", "Да", "Спорт") считаются неясными
+и язык не определяют: остается язык по умолчанию или прежний.
+
+LanguageState хранит язык пользователя с гистерезисом: одно голосовое
+или короткое сообщение на другом языке не переключает ответы.
+"""
+import math
+import re
+from collections import Counter
+
+KY_LETTERS_RE = re.compile(r"[ңөү]")
+WORD_RE = re.compile(r"[а-яёңөүa-z]+")
+
+KY_WORDS = (
+    'ооба', 'жок', 'эмне', 'эмнеге', 'кантип', 'канча', 'кайда', 'качан', 'кайсы', 'ким', 'барбы',
+    'бар', 'керек', 'жана', 'менен', 'менин', 'сиз', 'сиздер', 'силер', 'мен', 'биз', 'бул', 'ошол',
+    'болот', 'болобу', 'беле', 'экен', 'деп', 'да', 'го', 'саламатсызбы', 'жакшы', 'абдан', 'сабак',
+    'сабактар', 'курстар', 'баасы', 'узактыгы', 'графиги', 'жазылайын', 'жазылам', 'жазылсам',
+    'катталуу', 'тиркеме', 'балам', 'уулум', 'кызым', 'жашта', 'жашар', 'айтып', 'бериңиз', 'берсеңиз',
+    'билгим', 'келет', 'окуу', 'окуйт', 'турат', 'дагы', 'эле', 'гана', 'азыр', 'эртең', 'бүгүн',
+)
+RU_WORDS = (
+    'да', 'нет', 'что', 'как', 'где', 'когда', 'сколько', 'какой', 'какие', 'какая', 'кто', 'это',
+    'есть', 'можно', 'нужно', 'хочу', 'хотим', 'хотел', 'хотела', 'здравствуйте', 'привет', 'спасибо',
+    'пожалуйста', 'подскажите', 'скажите', 'расскажите', 'и', 'в', 'на', 'не', 'с', 'по', 'для', 'у',
+    'вас', 'вы', 'мне', 'мой', 'моя', 'мою', 'меня', 'я', 'он', 'она', 'они', 'чтобы', 'или', 'но',
+    'уже', 'еще', 'ещё', 'тоже', 'лет', 'год', 'курс', 'курсы', 'стоит', 'стоимость', 'цена',
+    'занятия', 'запись', 'записаться', 'ребенку', 'ребёнку', 'сыну', 'дочке', 'сегодня', 'завтра',
+)
+# Вопросительные частицы -бы/-би/-бу/-бү/-пы/-пи/-пу/-пү в конце слова: "барбы", "болобу".
+# Гласная частицы согласуется с последней гласной основы, поэтому русские
+# "трубы", "зубы", "грибы" частицей не считаются
+KY_HARMONY = {'аы': 'ы', 'еи': 'и', 'оу': 'у', 'өү': 'ү'}
+KY_SUFFIX_RE = re.compile(r"\b(?:" + "|".join(
+    rf"\w*[{stem}][^аеёиоуыэюяөү\W]*[бп]{particle}" for stem, particle in KY_HARMONY.items()
+) + r")\b")
+
+# Образцы текста для триграммной модели. Не пересекаются с размеченным корпусом в bench/data
+SEED_TEXTS = {
+    'ru': (
+        "Здравствуйте, хочу узнать подробнее о ваших курсах программирования. Сколько стоит обучение "
+        "и как проходят занятия? Моему ребенку одиннадцать лет, он любит компьютерные игры, подойдет ли "
+        "ему курс по созданию игр? Подскажите, пожалуйста, где находится ваш учебный центр и есть ли "
+        "парковка рядом. Можно ли оплатить обучение частями или нужно вносить всю сумму сразу? Какие "
+        "документы нужны для записи? Я работаю до шести вечера, есть ли группы по выходным или вечером? "
+        "Спасибо за ответ, мы подумаем и перезвоним завтра. Преподаватели у вас опытные? После окончания "
+        "выдается сертификат? Сколько учеников обычно в группе и сколько длится одно занятие? Нужно ли "
+        "приносить свой ноутбук или компьютеры предоставляются? Хотелось бы записаться на бесплатный "
+        "пробный урок в эту субботу. Мой номер телефона уже оставил, жду звонка менеджера. Расскажите, "
+        "чем отличается фронтенд от бэкенда и что лучше выбрать новичку без опыта. Спортом занимаюсь по "
+        "утрам, поэтому удобнее вечерние группы. Где можно посмотреть отзывы выпускников?"
+    ),
+    'ky': (
+        "Саламатсызбы, программалоо курстарыңыз тууралуу толугураак билгим келет. Окуу канча турат жана "
+        "сабактар кандай өтөт? Балам он бир жашта, компьютердик оюндарды жакшы көрөт, ага оюн жасоо курсу "
+        "туура келеби? Айтып койсоңуз, окуу борборуңар кайда жайгашкан жана жанында унаа токтотчу жай "
+        "барбы? Окуунун акысын бөлүп төлөсө болобу же бардык сумманы дароо төлөш керекпи? Жазылуу үчүн "
+        "кандай документтер керек? Мен кечки алтыга чейин иштейм, дем алыш күндөрү же кечинде топтор "
+        "барбы? Жообуңуз үчүн рахмат, ойлонуп көрүп эртең чалабыз. Мугалимдериңиз тажрыйбалуубу? Окууну "
+        "бүтүргөндөн кийин сертификат берилеби? Топто адатта канча окуучу болот жана бир сабак канча "
+        "убакытка созулат? Өзүмдүн ноутбугумду алып келишим керекпи же компьютерлер берилеби? Ушул ишемби "
+        "күнү акысыз сынамык сабакка жазылгым келет. Телефон номеримди калтырдым, менеджердин чалуусун "
+        "күтөм. Фронтенд менен бэкенддин айырмасы эмнеде жана тажрыйбасы жок адамга кайсынысын тандаган "
+        "жакшы экенин айтып бериңизчи. Эртең менен спорт менен алектенем, ошондуктан кечки топтор ыңгайлуу. "
+        "Бүтүрүүчүлөрдүн пикирлерин кайдан көрсөм болот?"
+    ),
+}
+
+LETTER_WEIGHT = 3.0  # первая буква ң/ө/ү; каждая следующая добавляет половину, не больше MAX_LETTER_SCORE
+MAX_LETTER_SCORE = 6.0
+WORD_WEIGHT = 1.2
+SUFFIX_WEIGHT = 0.8
+NGRAM_WEIGHT = 0.35
+MAX_NGRAM_SCORE = 4.0
+NEUTRAL_BAND = 1.0  # |score| меньше этого — язык сообщения неясен
+
+
+def _trigrams(text):
+    for word in WORD_RE.findall(text):
+        padded = f" {word} "
+        for i in range(len(padded) - 2):
+            yield padded[i:i + 3]
+
+
+def _train_ngram_ratios(texts):
+    """log(P_ky / P_ru) для каждой триграммы с аддитивным сглаживанием."""
+    counts = {lang: Counter(_trigrams(text.lower())) for lang, text in texts.items()}
+    vocabulary = set(counts['ru']) | set(counts['ky'])
+    totals = {lang: sum(counter.values()) + len(vocabulary) for lang, counter in counts.items()}
+    ratios = {
+        gram: math.log((counts['ky'][gram] + 1) / totals['ky']) - math.log((counts['ru'][gram] + 1) / totals['ru'])
+        for gram in vocabulary
+    }
+    return ratios
+
+
+def _word_pattern(words):
+    return re.compile(r"\b(?:" + "|".join(sorted(map(re.escape, set(words)), key=len, reverse=True)) + r")\b")
+
+
+NGRAM_RATIOS = _train_ngram_ratios(SEED_TEXTS)
+# Слова, одинаковые в обоих языках (например, "да"), не засчитываются ни одному
+KY_WORDS_RE = _word_pattern(set(KY_WORDS) - set(RU_WORDS))
+RU_WORDS_RE = _word_pattern(set(RU_WORDS) - set(KY_WORDS))
+
+
+def language_score(text):
+    """Оценка языка текста: > 0 — кыргызский, < 0 — русский, около 0 — неясно."""
+    text = text.lower()
+    score = 0.0
+
+    letters = len(KY_LETTERS_RE.findall(text))
+    if letters:
+        score += min(MAX_LETTER_SCORE, LETTER_WEIGHT * (1 + (letters - 1) / 2))
+
+    score += WORD_WEIGHT * (len(KY_WORDS_RE.findall(text)) - len(RU_WORDS_RE.findall(text)))
+    score += SUFFIX_WEIGHT * len(KY_SUFFIX_RE.findall(text))
+
+    ngram = sum(NGRAM_RATIOS.get(gram, 0.0) for gram in _trigrams(text))
+    score += max(-MAX_NGRAM_SCORE, min(MAX_NGRAM_SCORE, NGRAM_WEIGHT * ngram))
+    return score
+
+
+def clear_score(text):
+    """language_score() или 0, если оценка попала в нейтральную зону."""
+    score = language_score(text)
+    return score if abs(score) >= NEUTRAL_BAND else 0.0
+
+
+def detect_language(text, default='ru'):
+    """Язык одного сообщения без учета истории; для неясных сообщений — default."""
+    score = clear_score(text)
+    if score > 0:
+        return 'ky'
+    if score < 0:
+        return 'ru'
+    return default
+
+
+class LanguageState:
+    """Язык ответов пользователю с гистерезисом.
+
+    balance накапливает оценки сообщений с затуханием; язык переключается,
+    только когда balance уходит за SWITCH_THRESHOLD в сторону другого языка.
+    Из устоявшегося состояния одного даже очень уверенного сообщения
+    недостаточно, двух подряд — достаточно.
+    """
+
+    __slots__ = ('lang', 'balance')
+
+    SWITCH_THRESHOLD = 2.0
+    MAX_STEP = 3.0
+    DECAY = 0.5
+    LIMIT = 6.0
+
+    def __init__(self, lang='ru', balance=None):
+        self.lang = lang
+        if balance is None:
+            balance = self.SWITCH_THRESHOLD if lang == 'ky' else -self.SWITCH_THRESHOLD
+        self.balance = balance
+
+    @classmethod
+    def from_first_message(cls, text, prior=None):
+        """Начальное состояние по первому сообщению; prior — язык интерфейса Telegram, если он ru/ky."""
+        score = clear_score(text) if text else 0.0
+        if prior == 'ky':
+            score += 1.0
+        elif prior == 'ru':
+            score -= 1.0
+        state = cls('ky' if score > 0 else 'ru', 0.0)
+        state.balance = max(-cls.MAX_STEP, min(cls.MAX_STEP, score))
+        return state
+
+    def observe(self, text, weight=1.0):
+        """Учитывает сообщение; возвращает True, если язык переключился."""
+        step = max(-self.MAX_STEP, min(self.MAX_STEP, clear_score(text))) * weight
+        self.balance = max(-self.LIMIT, min(self.LIMIT, self.balance * self.DECAY + step))
+        if self.lang == 'ru' and self.balance > self.SWITCH_THRESHOLD:
+            self.lang = 'ky'
+            return True
+        if self.lang == 'ky' and self.balance < -self.SWITCH_THRESHOLD:
+            self.lang = 'ru'
+            return True
+        return False
+
+    def to_dict(self):
+        return {'lang': self.lang, 'balance': self.balance}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data.get('lang', 'ru'), data.get('balance'))
@@ -0,0 +1,129 @@
+"""Легковесные метрики: гистограммы задержек, счетчики и вывод в формате Prometheus."""
+import bisect
+import time
+
+# Границы корзин в секундах: от 1 мс до ~90 с с шагом x1.5
+LATENCY_BUCKETS = tuple(0.001 * 1.5 ** i for i in range(29))
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами: запись — один bisect и инкремент."""
+
+    __slots__ = ('bounds', 'counts', 'count', 'total', 'max')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        """Оценка перцентиля: верхняя граница корзины, в которую он попадает."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for index, bucket_count in enumerate(self.counts):
+            cumulative += bucket_count
+            if cumulative >= rank:
+                return min(self.bounds[index], self.max) if index < len(self.bounds) else self.max
+        return self.max
+
+
+class _Timer:
+    __slots__ = ('histogram', 'started')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started)
+        return False
+
+
+class Metrics:
+    """Реестр метрик процесса."""
+
+    def __init__(self, prefix='bot'):
+        self.prefix = prefix
+        self.histograms = {}
+        self.counters = {}
+        # Источники мгновенных значений: имя -> функция, возвращающая dict чисел
+        self.gauge_sources = {}
+
+    def histogram(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        return histogram
+
+    def observe(self, name, seconds):
+        self.histogram(name).observe(seconds)
+
+    def timer(self, name):
+        """Контекстный менеджер, записывающий длительность блока в гистограмму name."""
+        return _Timer(self.histogram(name))
+
+    def inc(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def register_gauges(self, name, source):
+        self.gauge_sources[name] = source
+
+    def gauges(self):
+        values = {}
+        for name, source in self.gauge_sources.items():
+            for key, value in source().items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    values[f"{name}_{key}"] = value
+        return values
+
+    def render_prometheus(self):
+        lines = []
+        for name, histogram in sorted(self.histograms.items()):
+            metric = f"{self.prefix}_{name}_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(histogram.bounds, histogram.counts):
+                cumulative += bucket_count
+                lines.append(f'{metric}_bucket{{le="{bound:.4g}"}} {cumulative}')
+            lines.append(f'{metric}_bucket{{le="+Inf"}} {histogram.count}')
+            lines.append(f"{metric}_sum {histogram.total:.6f}")
+            lines.append(f"{metric}_count {histogram.count}")
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"# TYPE {self.prefix}_{name}_total counter")
+            lines.append(f"{self.prefix}_{name}_total {value}")
+        for name, value in sorted(self.gauges().items()):
+            lines.append(f"# TYPE {self.prefix}_{name} gauge")
+            lines.append(f"{self.prefix}_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """Краткая текстовая сводка с p50/p95/p99 в миллисекундах."""
+        lines = ["Этап: n, p50 / p95 / p99 / max, мс"]
+        for name, h in sorted(self.histograms.items()):
+            if not h.count:
+                continue
+            values = " / ".join(f"{h.percentile(q) * 1000:.1f}" for q in (0.5, 0.95, 0.99))
+            lines.append(f"{name}: {h.count}, {values} / {h.max * 1000:.1f}")
+        if self.counters:
+            lines.append("")
+            lines.extend(f"{name}: {value}" for name, value in sorted(self.counters.items()))
+        gauges = self.gauges()
+        if gauges:
+            lines.append("")
+            lines.extend(f"{name}: {value:.3g}" if isinstance(value, float) else f"{name}: {value}"
+                         for name, value in sorted(gauges.items()))
+        return "\n".join(lines)
@@ -0,0 +1,120 @@
+"""Локальный поиск по базе знаний и курсам для сокращения системного промпта.
+
+Модуль не зависит от Telegram, OpenAI и Google API, поэтому его можно
+использовать в офлайн-бенчмарке (bench/retrieval_benchmark.py).
+"""
+import math
+import re
+from collections import defaultdict
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+# Грубый стемминг: русские и кыргызские слова сильно изменяются по окончаниям,
+# поэтому сравниваем только начало слова
+STEM_LENGTH = 6
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+
+def tokenize(text):
+    return [token[:STEM_LENGTH] for token in TOKEN_RE.findall(text.lower())]
+
+
+def split_text(text, max_chars=800):
+    """Делит документ на фрагменты по абзацам, не длиннее max_chars."""
+    chunks = []
+    current = ""
+    for paragraph in text.split("\n"):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        while len(paragraph) > max_chars:
+            cut = paragraph.rfind(" ", 0, max_chars)
+            cut = cut if cut > 0 else max_chars
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(paragraph[:cut].strip())
+            paragraph = paragraph[cut:].strip()
+        if current and len(current) + len(paragraph) + 1 > max_chars:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n{paragraph}" if current else paragraph
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class RetrievalIndex:
+    """Лексический индекс BM25 с расширением запроса синонимами курсов.
+
+    Оценки считаются по инвертированным спискам: для каждого терма запроса
+    проходим только документы, где он встречается, и накапливаем вклад
+    в массив оценок, не перебирая весь корпус.
+    """
+
+    def __init__(self, chunks, synonyms=None):
+        # chunks: список пар (тип фрагмента, текст), тип — 'kb' или 'course'
+        self.chunks = list(chunks)
+        self.doc_lengths = []
+        self.postings = defaultdict(list)
+        for doc_id, (_, text) in enumerate(self.chunks):
+            tokens = tokenize(text)
+            self.doc_lengths.append(len(tokens))
+            counts = defaultdict(int)
+            for token in tokens:
+                counts[token] += 1
+            for token, tf in counts.items():
+                self.postings[token].append((doc_id, tf))
+        total = len(self.chunks)
+        self.avg_length = sum(self.doc_lengths) / total if total else 0.0
+        self.idf = {
+            token: math.log(1 + (total - len(docs) + 0.5) / (len(docs) + 0.5))
+            for token, docs in self.postings.items()
+        }
+        self.synonyms = self._compile_synonyms(synonyms or {})
+
+    @staticmethod
+    def _compile_synonyms(synonyms):
+        """Список (фраза-синоним, термы каноничного названия курса)."""
+        compiled = []
+        for canonical, aliases in synonyms.items():
+            canonical_terms = tokenize(canonical)
+            for alias in [canonical] + list(aliases):
+                compiled.append((alias.lower(), canonical_terms + tokenize(alias)))
+        return compiled
+
+    def expand_query(self, query):
+        query_lower = query.lower()
+        terms = tokenize(query_lower)
+        for alias, expansion in self.synonyms:
+            if alias in query_lower:
+                terms.extend(expansion)
+        return terms
+
+    def search(self, query, k=5, min_score=0.0):
+        """Возвращает до k фрагментов [(оценка, тип, текст)] по убыванию оценки."""
+        if not self.chunks:
+            return []
+        scores = [0.0] * len(self.chunks)
+        norm = BM25_K1 * (1 - BM25_B)
+        scale = BM25_K1 * BM25_B / self.avg_length if self.avg_length else 0.0
+        for term in set(self.expand_query(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for doc_id, tf in self.postings[term]:
+                denominator = tf + norm + scale * self.doc_lengths[doc_id]
+                scores[doc_id] += idf * tf * (BM25_K1 + 1) / denominator
+        ranked = sorted(
+            (doc_id for doc_id, score in enumerate(scores) if score > min_score),
+            key=lambda doc_id: scores[doc_id],
+            reverse=True,
+        )
+        return [(scores[doc_id],) + self.chunks[doc_id] for doc_id in ranked[:k]]
+
+
+def build_index(knowledge_base, course_lines, synonyms=None, max_chars=800):
+    chunks = [('kb', chunk) for chunk in split_text(knowledge_base, max_chars)]
+    chunks.extend(('course', line) for line in course_lines)
+    return RetrievalIndex(chunks, synonyms)
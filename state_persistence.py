@@ -0,0 +1,162 @@
+"""Сохранение context.user_data во внешнем хранилище (user_store) через механизм persistence PTB.
+
+Данные пользователя загружаются лениво, при первом апдейте от него после запуска
+процесса, поэтому в памяти держатся только активные чаты, а запуск не читает всю базу.
+Если чтение не удалось (например, SQLite занят другим воркером), оно повторяется
+со следующим апдейтом, а до успешной загрузки состояние пользователя не записывается:
+иначе новый пустой диалог затер бы в хранилище историю и язык пользователя.
+Изменения PTB передает раз в update_interval секунд; все они записываются
+в хранилище одной пачкой в пуле потоков, не блокируя event loop.
+"""
+import asyncio
+import logging
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+logger = logging.getLogger(__name__)
+
+
+class UserStatePersistence(BasePersistence):
+    """Persistence только для user_data; dump/restore переводят user_data в JSON-словарь и обратно."""
+
+    def __init__(self, store, dump, restore, update_interval=5):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.store = store
+        self.dump = dump
+        self.restore = restore
+        # user_id -> задача загрузки; после ее успешного завершения данные пользователя уже в памяти
+        self._loads = {}
+        # Пользователи, чья загрузка не удалась: их user_data собраны заново и не сохраняются
+        self._failed = set()
+        self._pending = {}
+        self._write_task = None
+        self.loaded = 0
+        self.written = 0
+        self.batches = 0
+        self.errors = 0
+
+    async def _run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+    async def get_user_data(self):
+        # Ничего не загружаем заранее: см. refresh_user_data
+        return {}
+
+    async def refresh_user_data(self, user_id, user_data):
+        """Вызывается PTB перед обработкой апдейта: подгружает состояние пользователя из хранилища."""
+        load = self._loads.get(user_id)
+        if load is None:
+            load = self._loads[user_id] = asyncio.ensure_future(self._load(user_id, user_data))
+        # Параллельные апдейты того же пользователя ждут одну и ту же загрузку
+        await asyncio.shield(load)
+
+    async def _load(self, user_id, user_data):
+        # Непустые user_data после неудачной загрузки — новый диалог, хранилище важнее
+        if user_data and user_id not in self._failed:
+            return
+        try:
+            data = await self._run(self.store.load, user_id)
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"Ошибка загрузки состояния пользователя {user_id}, повторим со следующим апдейтом: {e}")
+            self._failed.add(user_id)
+            self._loads.pop(user_id, None)
+            return
+        self._failed.discard(user_id)
+        if data:
+            user_data.update(self.restore(data))
+            self.loaded += 1
+
+    async def update_user_data(self, user_id, data):
+        if user_id in self._failed or user_id not in self._loads:
+            # Состояние не загружено из хранилища, запись затерла бы сохраненное
+            return
+        # Снимок делаем сразу, в event loop: данные продолжают меняться обработчиками
+        self._pending[user_id] = self.dump(data)
+        if self._write_task is None or self._write_task.done():
+            self._write_task = asyncio.create_task(self._write_batch())
+
+    async def _write_batch(self):
+        # PTB вызывает update_user_data для всех измененных пользователей разом,
+        # поэтому один проход event loop собирает их в одну пачку
+        await asyncio.sleep(0)
+        batch, self._pending = self._pending, {}
+        if not batch:
+            return
+        try:
+            await self._run(self.store.save_many, batch)
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"Ошибка записи состояния {len(batch)} пользователей: {e}")
+            # Неудачную пачку повторим со следующей, не затирая более свежие снимки
+            for user_id, data in batch.items():
+                self._pending.setdefault(user_id, data)
+            return
+        self.written += len(batch)
+        self.batches += 1
+
+    async def drop_user_data(self, user_id):
+        self._pending.pop(user_id, None)
+        self._loads.pop(user_id, None)
+        self._failed.discard(user_id)
+        await self._run(self.store.delete, user_id)
+
+    async def prune(self):
+        """Удаляет из хранилища состояние, устаревшее по TTL. Возвращает число удаленных."""
+        return await self._run(self.store.prune)
+
+    async def flush(self):
+        if self._write_task is not None:
+            await self._write_task
+        if self._pending:
+            await self._write_batch()
+        self.store.close()
+
+    def stats(self):
+        return {
+            'cached_users': len(self._loads),
+            'load_failed': len(self._failed),
+            'pending': len(self._pending),
+            'loaded': self.loaded,
+            'written': self.written,
+            'batches': self.batches,
+            'errors': self.errors,
+        }
+
+    # Остальные данные (chat_data, bot_data, callback_data, диалоги) бот не сохраняет
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
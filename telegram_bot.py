@@ -1,3 +1,7 @@
+import time
+
+PROCESS_STARTED = time.monotonic()  # Отсчет времени запуска, до тяжелых импортов
+
 import os
 import json
 import asyncio
@@ -5,19 +9,39 @@ import logging
 import re
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
-from telegram import Update
+from telegram import Bot, Update
+from telegram.error import BadRequest, RetryAfter, TelegramError
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from openai import OpenAI
-import gspread
-from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build
+from openai import APITimeoutError, AsyncOpenAI, RateLimitError
+import httpx
 import sys
 import urllib.parse
 import functools
-import tempfile  # Для создания временных файлов
-from pydub import AudioSegment  # Для работы с аудиофайлами, требует ffmpeg
+import contextlib
+import hashlib
+import gzip
+import tempfile
+import concurrent.futures
+import multiprocessing
+import threading
+from voice_convert import AudioConversionError, convert_to_mp3
+from retrieval import build_index
+from conversation_memory import ConversationMemory, estimate_tokens
+from answer_cache import AnswerCache, compile_synonyms, normalize_question
+from course_lookup import CourseLookup, FIELDS as COURSE_FIELDS
+from chat_dispatcher import ChatBusy, ChatDispatcher
+from admission import AdmissionController, backoff_delay
+from metrics import Metrics
+from user_store import open_user_store
+from state_persistence import UserStatePersistence
+from webhook_server import UpdateRouter, WebhookServer
+from language_detector import LanguageState
 
 import signal
+import atexit
+import queue
+import random
+import logging.handlers
 
 def signal_handler(sig, frame):
     logger.info('Получен сигнал завершения, останавливаем бот...')
@@ -33,16 +57,102 @@ signal.signal(signal.SIGTERM, signal_handler)
 # Например: r"C:\ffmpeg\bin" или r"C:\Users\NoutSpace\Desktop\ffmpeg-master-latest-win64-gpl-shared\bin"
 # os.environ["PATH"] += os.pathsep + r"C:\ffmpeg\bin"  # <-- УКАЖИТЕ АКТУАЛЬНЫЙ ПУТЬ К ВАШЕМУ BIN FFmpeg
 
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('bot.log', encoding='utf-8'),
-        logging.StreamHandler(sys.stdout)
-    ]
-)
+# Настройка логирования: запись в файл и консоль идет в фоновом потоке через очередь
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FILE = os.getenv("LOG_FILE", "bot.log")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# Доля запросов к GPT, для которых пишется сводка сообщений, и длина сообщений в логе
+LOG_PROMPT_SAMPLE_RATE = float(os.getenv("LOG_PROMPT_SAMPLE_RATE", "0.1"))
+LOG_MESSAGE_CHARS = int(os.getenv("LOG_MESSAGE_CHARS", "200"))
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """Кладет записи в ограниченную очередь; при переполнении отбрасывает только записи ниже WARNING."""
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if record.levelno >= logging.WARNING:
+                # Ошибки не теряем: ждем, пока фоновый поток освободит место
+                self.queue.put(record)
+            else:
+                self.dropped += 1
+
+
+def setup_logging():
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    file_handler = logging.handlers.RotatingFileHandler(
+        LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+    stream_handler = logging.StreamHandler(sys.stdout)
+    for handler in (file_handler, stream_handler):
+        handler.setFormatter(formatter)
+
+    queue_handler = BoundedQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    # Сообщение (и traceback) собирается до постановки в очередь, оформление — в фоновом потоке
+    queue_handler.setFormatter(logging.Formatter('%(message)s'))
+    logging.basicConfig(level=LOG_LEVEL, handlers=[queue_handler])
+    listener = logging.handlers.QueueListener(
+        queue_handler.queue, file_handler, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return queue_handler
+
+
+# Рабочие процессы пула конвертации (forkserver, spawn) заново импортируют главный модуль
+# как __mp_main__; второй RotatingFileHandler на тот же файл и поток записи им не нужны
+log_queue_handler = setup_logging() if multiprocessing.current_process().name == 'MainProcess' else None
 logger = logging.getLogger(__name__)  # Получаем логгер для использования в функциях
+metrics = Metrics()
+
+
+class StartupTimer:
+    """Длительность этапов запуска: от старта процесса до готовности принимать сообщения."""
+
+    def __init__(self, started):
+        self.last = started
+        self.started = started
+        self.phases = {}
+
+    def mark(self, name):
+        """Записывает этап name, длившийся с конца предыдущего этапа."""
+        now = time.monotonic()
+        self.phases[name] = now - self.last
+        self.last = now
+
+    def add(self, name, seconds):
+        """Этап, который шел параллельно с остальными (например, в фоновом потоке)."""
+        self.phases.setdefault(name, seconds)
+
+    def stats(self):
+        return dict(self.phases)
+
+    def summary(self):
+        return ", ".join(f"{name} {seconds:.2f} с" for name, seconds in self.phases.items())
+
+
+startup_timer = StartupTimer(PROCESS_STARTED)
+
+
+def shorten(text, limit=LOG_MESSAGE_CHARS):
+    return text if len(text) <= limit else f"{text[:limit]}…(+{len(text) - limit})"
+
+
+def describe_messages(messages):
+    """Сводка сообщений для лога: системный промпт — хэшем и длиной, остальные — обрезанными."""
+    parts = []
+    for m in messages:
+        if m['role'] == 'system' and len(m['content']) > LOG_MESSAGE_CHARS:
+            parts.append(f"system[{prompt_hash(m['content'])}, {len(m['content'])} симв.]")
+        else:
+            parts.append(f"{m['role']}: {shorten(m['content'])}")
+    return " | ".join(parts)
 
 load_dotenv()
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
@@ -50,9 +160,155 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 GOOGLE_SHEET_COURSES_ID = os.getenv("SHEET_ID_COURSES", "1XeTe3Ihvi2N8bvo6P-yBZL2j_8L2IlvN6bOPYmCu5z8")
 GOOGLE_DOC_ID = os.getenv("DOC_ID")
 
+# Альтернативные адреса API (локальные заглушки для нагрузочных тестов в bench/)
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL")
+
+# Настройки HTTP-пула и ограничения параллельных запросов к OpenAI
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "100"))
+OPENAI_MAX_KEEPALIVE = int(os.getenv("OPENAI_MAX_KEEPALIVE", "20"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
+OPENAI_CHAT_CONCURRENCY = int(os.getenv("OPENAI_CHAT_CONCURRENCY", "32"))
+OPENAI_TRANSCRIPTION_CONCURRENCY = int(os.getenv("OPENAI_TRANSCRIPTION_CONCURRENCY", "8"))
+
+# Модель, лимиты аккаунта OpenAI и политика повторов и деградации
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o")
+OPENAI_MAX_TOKENS = 500
+# Лимиты запросов и токенов в минуту для модели; 0 — без ограничения (по умолчанию)
+OPENAI_RPM_LIMIT = int(os.getenv("OPENAI_RPM_LIMIT", "0"))
+OPENAI_TPM_LIMIT = int(os.getenv("OPENAI_TPM_LIMIT", "0"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "3"))
+# Если ожидаемое ожидание в очереди основной модели больше порога, запрос сразу
+# уходит в более быструю и дешевую модель со своими лимитами
+OPENAI_FALLBACK_MODEL = os.getenv("OPENAI_FALLBACK_MODEL", "")
+OPENAI_FALLBACK_RPM_LIMIT = int(os.getenv("OPENAI_FALLBACK_RPM_LIMIT", "0"))
+OPENAI_FALLBACK_TPM_LIMIT = int(os.getenv("OPENAI_FALLBACK_TPM_LIMIT", "0"))
+OPENAI_DEGRADE_WAIT = float(os.getenv("OPENAI_DEGRADE_WAIT", "5"))
+
+# Потоковая выдача ответов GPT с постепенным редактированием сообщения
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "false").lower() in ("1", "true", "yes")
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))  # секунд между правками
+STREAM_MIN_CHARS = int(os.getenv("STREAM_MIN_CHARS", "20"))  # минимальный прирост текста для правки
+STREAM_CURSOR = " ▌"
+
+# Поиск релевантных фрагментов базы знаний вместо передачи всего документа в каждый запрос
+RETRIEVAL_ENABLED = os.getenv("RETRIEVAL_ENABLED", "false").lower() in ("1", "true", "yes")
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "6"))
+RETRIEVAL_MIN_SCORE = float(os.getenv("RETRIEVAL_MIN_SCORE", "1.0"))
+RETRIEVAL_CHUNK_CHARS = int(os.getenv("RETRIEVAL_CHUNK_CHARS", "800"))
+
+# Память диалога: бюджет токенов истории, размер буфера реплик и вытеснение неактивных пользователей
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "1500"))
+HISTORY_MAX_TURNS = int(os.getenv("HISTORY_MAX_TURNS", "20"))
+HISTORY_SUMMARY_CHARS = int(os.getenv("HISTORY_SUMMARY_CHARS", "600"))
+USER_IDLE_TTL = timedelta(hours=float(os.getenv("USER_IDLE_TTL_HOURS", "24")))
+
+# Кэш ответов на первые вопросы диалога (цены, расписание, адрес и т.п.)
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1000"))
+ANSWER_CACHE_TTL = timedelta(minutes=float(os.getenv("ANSWER_CACHE_TTL_MINUTES", "60")))
+
+# Ответы на простые вопросы о цене, длительности, графике и возрасте прямо из таблицы курсов
+COURSE_FAST_PATH = os.getenv("COURSE_FAST_PATH", "true").lower() in ("1", "true", "yes")
+COURSE_FAST_PATH_MAX_WORDS = int(os.getenv("COURSE_FAST_PATH_MAX_WORDS", "8"))
+
+# Голосовые сообщения: процессы для конвертации аудио и кэш расшифровок
+VOICE_CONVERT_WORKERS = int(os.getenv("VOICE_CONVERT_WORKERS", "2"))
+TRANSCRIPTION_CACHE_SIZE = int(os.getenv("TRANSCRIPTION_CACHE_SIZE", "2000"))
+TRANSCRIPTION_CACHE_TTL = timedelta(hours=float(os.getenv("TRANSCRIPTION_CACHE_TTL_HOURS", "24")))
+
+# Параллельная обработка обновлений: общий лимит, склейка быстрых сообщений и очередь на чат.
+# Сообщения склеиваются, пока чат занят ответом; MESSAGE_DEBOUNCE_SECONDS добавляет
+# ожидание перед каждым ответом, поэтому по умолчанию выключено
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "64"))
+MESSAGE_DEBOUNCE_SECONDS = float(os.getenv("MESSAGE_DEBOUNCE_SECONDS", "0"))
+CHAT_MAX_PENDING = int(os.getenv("CHAT_MAX_PENDING", "5"))
+
+# Статистика: команда /stats для администраторов и, если задан порт, HTTP-эндпоинт /metrics
+ADMIN_USER_IDS = {int(x) for x in os.getenv("ADMIN_USER_IDS", "").replace(" ", "").split(",") if x}
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+# Режим работы: polling (по умолчанию) или webhook со встроенным HTTP-сервером
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")  # публичный адрес; если задан, webhook регистрируется в Telegram
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8443")))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None
+# Адреса воркеров через запятую: тогда процесс только принимает webhook и раскладывает чаты по воркерам
+WEBHOOK_WORKERS = [x for x in os.getenv("WEBHOOK_WORKERS", "").replace(" ", "").split(",") if x]
+
+# Хранилище состояния пользователей: sqlite:///user_state.db, file://user_state или redis://...
+# Пусто — состояние живет только в памяти процесса, как раньше
+USER_STATE_STORE = os.getenv("USER_STATE_STORE", "")
+USER_STATE_FLUSH_SECONDS = float(os.getenv("USER_STATE_FLUSH_SECONDS", "5"))
+
 # Обработка Google Service Account для Railway
 SERVICE_ACCOUNT_FILE = 'service_account_key.json'
 
+class ConcurrencyGovernor:
+    """Ограничивает число одновременных запросов к API и считает очередь ожидания."""
+
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = limit
+        self._semaphore = asyncio.Semaphore(limit)
+        self.waiting = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        self.waiting += 1
+        started = time.monotonic()
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        wait = time.monotonic() - started
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.in_flight += 1
+        try:
+            yield wait
+        finally:
+            self.in_flight -= 1
+            self.completed += 1
+            self._semaphore.release()
+
+    def stats(self):
+        return {
+            'limit': self.limit,
+            'in_flight': self.in_flight,
+            'queue_depth': self.waiting,
+            'completed': self.completed,
+            'avg_wait': self.total_wait / self.completed if self.completed else 0.0,
+            'max_wait': self.max_wait,
+        }
+
+
+chat_governor = ConcurrencyGovernor('chat', OPENAI_CHAT_CONCURRENCY)
+chat_admission = AdmissionController(OPENAI_RPM_LIMIT, OPENAI_TPM_LIMIT)
+fallback_admission = AdmissionController(OPENAI_FALLBACK_RPM_LIMIT, OPENAI_FALLBACK_TPM_LIMIT)
+transcription_governor = ConcurrencyGovernor('transcription', OPENAI_TRANSCRIPTION_CONCURRENCY)
+
+
+def create_openai_client():
+    """Асинхронный клиент OpenAI с общим пулом HTTP-соединений."""
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+        ),
+        timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=10.0),
+    )
+    # Повторы делает chat_completion() с учетом общей очереди, а не сам клиент
+    return AsyncOpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL, http_client=http_client,
+                       timeout=OPENAI_TIMEOUT, max_retries=0)
+
+
 def setup_google_credentials():
     """Настройка Google credentials для Railway"""
     service_account_json = os.getenv('GOOGLE_SERVICE_ACCOUNT_JSON')
@@ -65,25 +321,76 @@ def setup_google_credentials():
         logger.error("Google Service Account файл не найден!")
         raise FileNotFoundError("service_account_key.json не найден")
 
-# Вызовите эту функцию в начале
-setup_google_credentials()
+SCOPES = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/documents.readonly']
+
+# Клиенты API создаются не при импорте модуля: OpenAI — в create_application(),
+# Google — при первом обращении к данным (ensure_google_clients)
+openai_client = None
+sheets_client = None
+docs_service = None
+sheet_courses = None
+google_clients_lock = threading.Lock()
+
 
-try:
-    openai_client = OpenAI(api_key=OPENAI_API_KEY)
-    SCOPES = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/documents.readonly']
-    creds = Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=SCOPES)
-    sheets_client = gspread.authorize(creds)
-    docs_service = build("docs", "v1", credentials=creds)
-    sheet_courses = sheets_client.open_by_key(GOOGLE_SHEET_COURSES_ID).worksheet("Лист1")
+def init_openai_client(client=None):
+    global openai_client
+    openai_client = client or create_openai_client()
+
+
+def init_google_clients(sheets=None, docs=None):
+    """Создает клиенты Google Sheets и Docs. Библиотеки Google импортируются только здесь.
+
+    Готовые объекты можно передать явно (например, заглушки в bench/run_bot_offline.py),
+    тогда для них не нужны ни ключи, ни сеть.
+    """
+    global sheets_client, docs_service, sheet_courses
+    try:
+        if sheets is None or docs is None:
+            from google.oauth2.service_account import Credentials
+
+            setup_google_credentials()
+            creds = Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=SCOPES)
+        if sheets is None:
+            import gspread
+
+            sheets = gspread.authorize(creds)
+        if docs is None:
+            from googleapiclient.discovery import build
+
+            # Документ discovery берется из копии в пакете: без запроса к googleapis.com и без file_cache
+            docs = build("docs", "v1", credentials=creds, static_discovery=True, cache_discovery=False)
+        worksheet = sheets.open_by_key(GOOGLE_SHEET_COURSES_ID).worksheet("Лист1")
+    except Exception as e:
+        logger.error(f"Ошибка подключения к Google API: {str(e)}")
+        raise
+    sheets_client, docs_service = sheets, docs
+    # sheet_courses присваивается последним: по нему ensure_google_clients понимает, что клиенты готовы
+    sheet_courses = worksheet
     logger.info("Подключение к Google Sheets и Docs успешно установлено")
-except Exception as e:
-    logger.error(f"Ошибка подключения к Google API: {str(e)}")
-    raise
+
+
+def ensure_google_clients():
+    """Создает клиенты Google при первом обращении; вызывается из потока обновления данных."""
+    if sheet_courses is not None:
+        return
+    with google_clients_lock:
+        if sheet_courses is None:
+            started = time.monotonic()
+            init_google_clients()
+            startup_timer.add('google_clients', time.monotonic() - started)
+
+
+def init_clients(openai=None, sheets=None, docs=None):
+    """Создает сразу все клиенты API (или принимает готовые)."""
+    init_openai_client(openai)
+    init_google_clients(sheets, docs)
 
 course_cache = {'ru': [], 'ky': []}
 knowledge_base_cache = {'ru': '', 'ky': ''}
-last_cache_update = datetime.min
 CACHE_LIFETIME = timedelta(minutes=30)  # Время жизни кэша
+# Локальный снимок курсов и базы знаний для быстрого старта без ожидания Google API
+CACHE_SNAPSHOT_PATH = os.getenv("CACHE_SNAPSHOT_PATH", "cache_snapshot.json.gz")
+CACHE_SNAPSHOT_VERSION = 1
 
 COURSE_SYNONYMS = {
     'ru': {
@@ -114,6 +421,7 @@ MESSAGES = {
         'openai_auth_error': "Извините, произошла ошибка аутентификации. Сообщите администратору.",
         'openai_timeout_error': "Извините, запрос к серверу занял слишком много времени. Попробуйте еще раз.",
         'openai_unknown_error': "Извините, произошла внутренняя ошибка. Попробуйте еще раз или свяжитесь с поддержкой.",
+        'chat_busy': "Пожалуйста, подождите, я еще отвечаю на ваши предыдущие сообщения.",
         'no_course_info_available': "Информация о курсах пока недоступна в полном объеме. Сообщите администратору, чтобы он добавил курсы или уточните позже.",
         'off_topic_response': "К сожалению, я не могу помочь с этим вопросом, но могу рассказать о наших курсах в IT Run Academy. У нас есть отличные программы, которые могут вас заинтересовать. Хотите, чтобы я рассказала подробнее?",
         # Новая фраза для записи через форму
@@ -124,6 +432,18 @@ MESSAGES = {
         'trial_lesson_invite': "Также приглашаем вас на наш бесплатный пробный урок, который проводится каждую субботу. Это отличная возможность познакомиться с нами ближе!",
         'post_consultation_prompt': "Если вы хотите записаться, пожалуйста, скажите об этом.",
         'cooperation_contact_prompt': "По вопросам сотрудничества или практики, пожалуйста, свяжитесь с нашим менеджером по номеру: [НОМЕР_МЕНЕДЖЕРА_ДЛЯ_СОТРУДНИЧЕСТВА].",
+        # Заголовки и ссылки для разделов промпта, которые вынесены в его конец
+        'prompt_kb_title': "База знаний:",
+        'prompt_courses_title': "Доступные курсы:",
+        'prompt_kb_ref': "(см. раздел \"База знаний\" в конце инструкции)",
+        'prompt_courses_ref': "(см. раздел \"Доступные курсы\" в конце инструкции)",
+        'prompt_kb_not_needed': "(для этого вопроса достаточно данных о курсах ниже)",
+        # Шаблоны быстрых ответов по данным таблицы курсов
+        'course_fast_header': "Курс «{name}»:",
+        'course_field_price': "Стоимость: {value} в месяц",
+        'course_field_duration': "Продолжительность: {value}",
+        'course_field_schedule': "График учебы: {value}",
+        'course_field_age': "Возраст: {value}",
     },
     'ky': {
         'welcome': "Салам! Мен IT Run Academyнин виртуалдык менеджеримин. Мен сизге курстарыбыз жана мүмкүнчүлүктөрүбүз жөнүндө маалымат берүүгө даярмын. Кантип жардам бере алам?",
@@ -133,6 +453,7 @@ MESSAGES = {
         'openai_auth_error': "Кечиресиз, аутентификация катасы кетти. Администраторго билдириңиз.",
         'openai_timeout_error': "Кечиресиз, серверге суроо-талап узак убакытты алды. Кайра аракет кылыңыз.",
         'openai_unknown_error': "Кечиресиз, ички ката кетти. Кайра аракет кылыңыз же колдоо кызматына кайрылыңыз.",
+        'chat_busy': "Сураныч, күтө туруңуз, мен мурунку билдирүүлөрүңүзгө жооп берип жатам.",
         'no_course_info_available': "Курстар жөнүндө маалымат толук жеткиликсиз. Администраторго билдириңиз же кийинчерээк тактаңыз.",
         'off_topic_response': "Кечиресиз, бул суроого жардам бере албайм, бирок IT Run Academyдеги курстарыбыз жөнүндө айта алам. Бизде сизди кызыктыра турган сонун программалар бар. Кененирээк айтып берейинби?",
         'enrollment_form_prompt': "Абдан сонун! Катталуу же кененирээк кеңеш алуу үчүн, сураныч, бул форманы толтуруңуз: [ https://forms.gle/dMNnnnaRnQv7pagG7 ]. Ошондой эле сиз биздин академияга жеке өзүңүз келип кайрылсаңыз болот: [Академиянын дареги базадан]. Биз [Иш убактысы базадан] иштейбиз. Сизди күтөбүз!",
@@ -140,12 +461,22 @@ MESSAGES = {
         'trial_lesson_invite': "Ошондой эле сизди ар ишемби сайын өтүүчү акысыз сыноо сабагыбызга чакырабыз. Бул биз менен жакындан таанышууга эң сонун мүмкүнчүлүк!",
         'post_consultation_prompt': "Эгер сиз жазылгыңыз келсе, айтыңыз.",
         'cooperation_contact_prompt': "Кызматташуу же практика боюнча суроолор үчүн, биздин менеджер менен бул номер аркылуу байланышыңыз: [НОМЕР_МЕНЕДЖЕРА_ДЛЯ_СОТРУДНИЧЕСТВА].",
+        'prompt_kb_title': "Маалымат базасы:",
+        'prompt_courses_title': "Жеткиликтүү курстар:",
+        'prompt_kb_ref': "(нускаманын аягындагы \"Маалымат базасы\" бөлүмүн караңыз)",
+        'prompt_courses_ref': "(нускаманын аягындагы \"Жеткиликтүү курстар\" бөлүмүн караңыз)",
+        'prompt_kb_not_needed': "(бул суроо үчүн төмөндөгү курстар тууралуу маалымат жетиштүү)",
+        'course_fast_header': "«{name}» курсу:",
+        'course_field_price': "Баасы: айына {value}",
+        'course_field_duration': "Узактыгы: {value}",
+        'course_field_schedule': "Окуу графиги: {value}",
+        'course_field_age': "Жаш чеги: {value}",
     }
 }
 
 
-def get_knowledge_base(lang_code):
-    """Синхронная функция для загрузки базы знаний из Google Docs."""
+def get_knowledge_base():
+    """Синхронная функция для загрузки базы знаний из Google Docs. Возвращает (текст, revisionId)."""
     doc = docs_service.documents().get(documentId=GOOGLE_DOC_ID).execute()
     content = doc.get("body").get("content")
     text = ""
@@ -154,316 +485,1157 @@ def get_knowledge_base(lang_code):
             for text_run in element["paragraph"]["elements"]:
                 if "textRun" in text_run:
                     text += text_run["textRun"]["content"]
-    knowledge_base_cache[lang_code] = text
-    return text
+    return text, doc.get("revisionId")
+
+
+def get_knowledge_base_revision():
+    """Запрашивает только revisionId документа, без его содержимого."""
+    doc = docs_service.documents().get(documentId=GOOGLE_DOC_ID, fields="revisionId").execute()
+    return doc.get("revisionId")
+
+
+def rebuild_derived_caches():
+    """Пересобирает все, что строится из курсов и базы знаний, после их загрузки."""
+    old_versions = {lang: entry['version'] for lang, entry in prompt_cache.items()}
+    rebuild_prompt_cache()
+    rebuild_retrieval_index()
+    rebuild_course_lookup()
+    new_versions = {lang: entry['version'] for lang, entry in prompt_cache.items()}
+    if new_versions != old_versions and len(answer_cache):
+        logger.info(f"Данные изменились, кэш ответов очищен ({len(answer_cache)} записей).")
+        answer_cache.clear()
+
+
+class RefreshCoordinator:
+    """Обновляет курсы и базу знаний не более чем одной задачей за раз.
+
+    Одновременные вызовы ждут уже идущее обновление. Читатели все это время
+    получают последний удачный снимок: course_cache и knowledge_base_cache
+    заменяются целиком в event loop только после успешной загрузки.
+    """
+
+    def __init__(self, lifetime, retry_interval=timedelta(minutes=1)):
+        self.lifetime = lifetime
+        self.retry_interval = retry_interval
+        self.last_success = datetime.min
+        self.last_attempt = datetime.min
+        self.sheet_hash = None
+        self.doc_revision = None
+        self._task = None
+        self.refreshes = 0
+        self.joined = 0
+        self.failures = 0
+        self.unchanged = 0
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def is_stale(self):
+        now = datetime.now()
+        return now - self.last_success > self.lifetime and now - self.last_attempt > self.retry_interval
+
+    def fetch(self):
+        """Синхронно загружает изменившиеся данные.
+
+        Возвращает (курсы, база знаний); для неизменившегося источника — None.
+        Ошибка Google Sheets не мешает обновить базу знаний, ошибка Google Docs пробрасывается.
+        """
+        ensure_google_clients()
+        courses = None
+        try:
+            records = sheet_courses.get_all_records()
+            sheet_hash = hashlib.sha256(
+                json.dumps(records, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+            if sheet_hash != self.sheet_hash:
+                courses = (parse_course_records(records), sheet_hash)
+            else:
+                self.unchanged += 1
+                logger.info("Таблица курсов не изменилась, разбор пропущен.")
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке курсов из Google Sheets: {str(e)}")
+
+        # Документ один для обоих языков: сначала сверяем ревизию, и только при изменении скачиваем
+        knowledge_base = None
+        revision = get_knowledge_base_revision() if self.doc_revision else None
+        if revision is None or revision != self.doc_revision:
+            knowledge_base = get_knowledge_base()
+        else:
+            self.unchanged += 1
+            logger.info(f"База знаний не изменилась (ревизия {revision}), загрузка пропущена.")
+        return courses, knowledge_base
+
+    def apply(self, courses, knowledge_base):
+        """Подменяет снимок данных и пересобирает производные кэши, если что-то изменилось."""
+        changed = False
+        if courses is not None:
+            (courses_ru, courses_ky), self.sheet_hash = courses
+            course_cache['ru'] = courses_ru
+            course_cache['ky'] = courses_ky
+            logger.info(f"Загружено {len(courses_ru)} курсов для RU и {len(courses_ky)} для KY из Google Sheets.")
+            changed = True
+        if knowledge_base is not None:
+            text, self.doc_revision = knowledge_base
+            for lang in ['ru', 'ky']:
+                knowledge_base_cache[lang] = text
+            changed = True
+        if changed or not prompt_cache:
+            rebuild_derived_caches()
+        self.last_success = datetime.now()
+        return changed
+
+    def snapshot_data(self):
+        return {
+            'version': CACHE_SNAPSHOT_VERSION,
+            'saved_at': datetime.now().isoformat(),
+            'course_cache': dict(course_cache),
+            'knowledge_base_cache': dict(knowledge_base_cache),
+            'sheet_hash': self.sheet_hash,
+            'doc_revision': self.doc_revision,
+        }
+
+    @staticmethod
+    def save_snapshot(data, path=CACHE_SNAPSHOT_PATH):
+        """Атомарно записывает снимок: во временный файл рядом, затем os.replace.
+
+        Имя временного файла уникально, поэтому воркеры, сохраняющие снимок
+        одновременно, не пишут в один файл.
+        """
+        directory, name = os.path.split(path)
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=directory or '.', prefix=f"{name}.", suffix='.tmp')
+            with os.fdopen(fd, 'wb') as raw, gzip.open(raw, 'wt', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+            os.replace(tmp_path, path)
+            tmp_path = None
+            logger.info(f"Снимок кэша сохранен: {path}")
+        except OSError as e:
+            logger.error(f"Не удалось сохранить снимок кэша {path}: {e}")
+        finally:
+            if tmp_path is not None:
+                with contextlib.suppress(OSError):
+                    os.remove(tmp_path)
+
+    def load_snapshot(self, path=CACHE_SNAPSHOT_PATH):
+        """Загружает локальный снимок. Данные считаются устаревшими и перепроверяются в фоне."""
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            logger.info(f"Снимок кэша {path} не найден, данные будут загружены из Google.")
+            return False
+        except (OSError, ValueError) as e:
+            logger.error(f"Снимок кэша {path} поврежден: {e}")
+            return False
+        if data.get('version') != CACHE_SNAPSHOT_VERSION:
+            logger.warning(f"Снимок кэша {path} устаревшего формата, пропускаем.")
+            return False
+        for lang in ['ru', 'ky']:
+            course_cache[lang] = data['course_cache'].get(lang, [])
+            knowledge_base_cache[lang] = data['knowledge_base_cache'].get(lang, '')
+        self.sheet_hash = data.get('sheet_hash')
+        self.doc_revision = data.get('doc_revision')
+        # Производные кэши зависят от шаблонов промптов в коде, поэтому собираем их заново
+        rebuild_derived_caches()
+        logger.info(f"Загружен снимок кэша от {data.get('saved_at')}.")
+        return True
+
+    def refresh_sync(self):
+        """Синхронное обновление для запуска до старта event loop."""
+        self.last_attempt = datetime.now()
+        if self.apply(*self.fetch()):
+            self.save_snapshot(self.snapshot_data())
+        self.refreshes += 1
+
+    async def _run(self):
+        logger.info("Обновление кэша: загрузка курсов и базы знаний.")
+        self.last_attempt = datetime.now()
+        started = time.monotonic()
+        try:
+            courses, knowledge_base = await asyncio.to_thread(self.fetch)
+        except Exception as e:
+            self.failures += 1
+            logger.error(f"Ошибка обновления кэша, используется последний удачный снимок: {e}")
+            return False
+        if self.apply(courses, knowledge_base):
+            await asyncio.to_thread(self.save_snapshot, self.snapshot_data())
+        self.refreshes += 1
+        metrics.observe('cache_refresh', time.monotonic() - started)
+        logger.info(f"Кэш успешно обновлен за {time.monotonic() - started:.2f} с.")
+        return True
+
+    async def refresh(self, force=False):
+        """Обновляет данные, если они устарели; одновременные вызовы разделяют одно обновление."""
+        if self.running:
+            self.joined += 1
+        elif force or self.is_stale():
+            self._task = asyncio.create_task(self._run())
+        else:
+            logger.info("Кэш актуален, обновление не требуется.")
+            return False
+        return await asyncio.shield(self._task)
+
+    def refresh_in_background(self):
+        """Запускает обновление, не дожидаясь его: обработчики отвечают по текущему снимку."""
+        if not self.running and self.is_stale():
+            self._task = asyncio.create_task(self._run())
+
+    def stats(self):
+        return {
+            'refreshes': self.refreshes,
+            'joined': self.joined,
+            'failures': self.failures,
+            'unchanged': self.unchanged,
+            'last_success': self.last_success.isoformat(timespec='seconds'),
+            'doc_revision': self.doc_revision,
+        }
+
+
+refresh_coordinator = RefreshCoordinator(CACHE_LIFETIME)
 
 
 async def refresh_cache():
-    global last_cache_update
-    if datetime.now() - last_cache_update > CACHE_LIFETIME:
-        logger.info("Обновление кэша: загрузка курсов и базы знаний.")
-        await asyncio.to_thread(load_courses_from_sheets)
-        for lang in ['ru', 'ky']:
-            knowledge_base_cache[lang] = await asyncio.to_thread(get_knowledge_base, lang)
-        last_cache_update = datetime.now()
-        logger.info("Кэш успешно обновлен.")
-    else:
-        logger.info("Кэш актуален, обновление не требуется.")
+    return await refresh_coordinator.refresh()
 
 
 async def refresh_cache_job(context: ContextTypes.DEFAULT_TYPE):
     logger.info("Плановое обновление кэша...")
     await refresh_cache()
     logger.info("Плановое обновление кэша завершено.")
-
-
-def load_courses_from_sheets():
-    """Синхронная функция для загрузки курсов из Google Sheets."""
-    global course_cache
+    logger.info(f"Допуск к OpenAI: {chat_admission.stats()}")
+    if OPENAI_FALLBACK_MODEL:
+        logger.info(f"Допуск к резервной модели: {fallback_admission.stats()}")
+    logger.info(f"Очередь OpenAI: chat={chat_governor.stats()}, "
+                f"transcription={transcription_governor.stats()}")
+    logger.info(f"Кэш ответов: {answer_cache.stats()}, кэш расшифровок: {transcription_cache.stats()}")
+    logger.info(f"Обновления данных: {refresh_coordinator.stats()}")
+    logger.info(f"Очереди чатов: {chat_dispatcher.stats()}")
+    if log_queue_handler.dropped:
+        logger.warning(f"Отброшено записей лога при переполнении очереди: {log_queue_handler.dropped}")
+
+
+async def post_shutdown(application: Application):
+    """Закрывает общий пул HTTP-соединений OpenAI и пул конвертации аудио при остановке бота."""
+    await openai_client.close()
+    metrics_server = application.bot_data.get('metrics_server')
+    if metrics_server is not None:
+        metrics_server.close()
+    if voice_process_pool is not None:
+        voice_process_pool.shutdown(wait=False, cancel_futures=True)
+
+
+def parse_course_records(records):
+    """Разбирает строки Google Sheets в списки курсов для RU и KY."""
+    courses_ru, courses_ky = [], []
+    for record in records:
+        course_ru_name = record.get('Название курса', '').strip()
+        if course_ru_name:
+            courses_ru.append({
+                'Название курса': course_ru_name,
+                'Описание': record.get('Описание', 'Описание отсутствует.'),
+                'Цена / на месяц': record.get('Цена / на месяц', 'Цена не указана.'),
+                'Продолжительность': record.get('Продолжительность', 'Продолжительность не указана.'),
+                'график учебы': record.get('график учебы', 'График не указан.'),
+                'возрастное ограничение': record.get('возрастное ограничение', 'Возраст не указан.')
+            })
+        course_ky_name = record.get('Название курса (Кырг.)', course_ru_name).strip()
+        if course_ky_name:
+            courses_ky.append({
+                'Название курса': course_ky_name,
+                'Описание': record.get('Описание (Кырг.)', record.get('Описание', 'Сүрөттөмө жок.')),
+                'Цена / на месяц': record.get('Цена / на месяц', 'Баасы көрсөтүлгөн эмес.'),
+                'Продолжительность': record.get('Продолжительность', 'Узактыгы көрсөтүлгөн эмес.'),
+                'график учебы': record.get('график учебы (Кырг.)',
+                                           record.get('график учебы', 'График көрсөтүлгөн эмес.')),
+                'возрастное ограничение': record.get('возрастное ограничение (Кырг.)',
+                                                     record.get('возрастное ограничение', 'Жашы көрсөтүлгөн эмес.'))
+            })
+    return courses_ru, courses_ky
+
+
+# Отрендеренные системные промпты: lang -> {'text', 'prefix', 'version', 'prefix_version'}
+prompt_cache = {}
+# Шаблоны промптов читаются с диска один раз за время жизни процесса
+prompt_templates = {}
+
+
+def load_prompt_template(lang_code):
+    """Возвращает шаблон промпта для языка, читая файл только при первом обращении."""
+    if lang_code in prompt_templates:
+        return prompt_templates[lang_code]
+    prompt_file_path = f"system_prompt_{lang_code}.txt"
     try:
-        records = sheet_courses.get_all_records()
-        courses_ru, courses_ky = [], []
-        for record in records:
-            course_ru_name = record.get('Название курса', '').strip()
-            if course_ru_name:
-                courses_ru.append({
-                    'Название курса': course_ru_name,
-                    'Описание': record.get('Описание', 'Описание отсутствует.'),
-                    'Цена / на месяц': record.get('Цена / на месяц', 'Цена не указана.'),
-                    'Продолжительность': record.get('Продолжительность', 'Продолжительность не указана.'),
-                    'график учебы': record.get('график учебы', 'График не указан.'),
-                    'возрастное ограничение': record.get('возрастное ограничение', 'Возраст не указан.')
-                })
-            course_ky_name = record.get('Название курса (Кырг.)', course_ru_name).strip()
-            if course_ky_name:
-                courses_ky.append({
-                    'Название курса': course_ky_name,
-                    'Описание': record.get('Описание (Кырг.)', record.get('Описание', 'Сүрөттөмө жок.')),
-                    'Цена / на месяц': record.get('Цена / на месяц', 'Баасы көрсөтүлгөн эмес.'),
-                    'Продолжительность': record.get('Продолжительность', 'Узактыгы көрсөтүлгөн эмес.'),
-                    'график учебы': record.get('график учебы (Кырг.)',
-                                               record.get('график учебы', 'График көрсөтүлгөн эмес.')),
-                    'возрастное ограничение': record.get('возрастное ограничение (Кырг.)',
-                                                         record.get('возрастное ограничение', 'Жашы көрсөтүлгөн эмес.'))
-                })
-        course_cache['ru'] = courses_ru
-        course_cache['ky'] = courses_ky
-        logger.info(f"Загружено {len(courses_ru)} курсов для RU и {len(courses_ky)} для KY из Google Sheets.")
-    except Exception as e:
-        logger.error(f"Ошибка при загрузке курсов из Google Sheets: {str(e)}")
-        pass
-
+        with open(prompt_file_path, 'r', encoding='utf-8') as f:
+            base_prompt = f.read()
+    except FileNotFoundError:
+        logger.error(f"Файл промпта не найден: {prompt_file_path}. Используется резервный промпт.")
+        base_prompt = (
+            "You are an IT Run Academy virtual manager. Provide information about courses and academy. "
+            "Use provided knowledge base and course info. If information is missing, ask to fill the form."
+        )
+    prompt_templates[lang_code] = base_prompt
+    return base_prompt
 
-def get_system_prompt(lang_code):
-    knowledge_base = knowledge_base_cache.get(lang_code, '')
-    if not knowledge_base:
-        logger.warning(f"База знаний для языка {lang_code} пуста в кэше. Попытка загрузки.")
-        knowledge_base = get_knowledge_base(lang_code)
-        if not knowledge_base:
-            logger.error(f"Не удалось загрузить базу знаний для языка {lang_code}.")
-            knowledge_base = "Информация об академии временно недоступна."
 
-    courses = course_cache.get(lang_code, [])
-    courses_str = "\n".join([
+def format_course_line(c):
+    return (
         f"- {c['Название курса']}: {c.get('Описание', 'Описание отсутствует.')}, "
         f"Цена: {c.get('Цена / на месяц', 'Цена не указана.')}, "
         f"Продолжительность: {c.get('Продолжительность', 'Продолжительность не указана.')}, "
         f"График учебы: {c.get('график учебы', 'График не указан.')}, "
         f"Возрастное ограничение: {c.get('возрастное ограничение', 'Возраст не указан.')}"
-        for c in courses
-    ])
+    )
+
+
+def build_courses_str(lang_code):
+    courses = course_cache.get(lang_code, [])
     if not courses:
-        courses_str = MESSAGES[lang_code]['no_course_info_available']
         logger.warning(f"Информация о курсах для языка {lang_code} пуста в кэше.")
+        return MESSAGES[lang_code]['no_course_info_available']
+    return "\n".join(format_course_line(c) for c in courses)
 
-    off_topic_response_example = MESSAGES[lang_code]['off_topic_response']
-    enrollment_form_prompt_example = MESSAGES[lang_code]['enrollment_form_prompt']
-    no_info_form_prompt_example = MESSAGES[lang_code]['no_info_form_prompt']
-    trial_lesson_invite_example = MESSAGES[lang_code]['trial_lesson_invite']
-    post_consultation_prompt_example = MESSAGES[lang_code]['post_consultation_prompt']
-    cooperation_contact_prompt_example = MESSAGES[lang_code]['cooperation_contact_prompt']
 
-    prompt_file_path = f"system_prompt_{lang_code}.txt"
-    try:
-        with open(prompt_file_path, 'r', encoding='utf-8') as f:
-            base_prompt = f.read()
-    except FileNotFoundError:
-        logger.error(f"Файл промпта не найден: {prompt_file_path}. Используется резервный промпт.")
-        base_prompt = (
-            "You are an IT Run Academy virtual manager. Provide information about courses and academy. "
-            "Use provided knowledge base and course info. If information is missing, ask to fill the form."
-        )
+def render_static_prompt(lang_code):
+    """Рендерит неизменяемую часть промпта (инструкции и фразы-примеры).
 
+    База знаний и курсы в шаблоне заменяются ссылками на разделы в конце промпта,
+    поэтому этот префикс побайтово совпадает между обновлениями кэша и может
+    кэшироваться на стороне OpenAI.
+    """
+    messages = MESSAGES[lang_code]
     try:
-        prompt = base_prompt.format(
-            knowledge_base=knowledge_base,
-            courses_str=courses_str,
-            off_topic_response_example=off_topic_response_example,
-            enrollment_form_prompt_example=enrollment_form_prompt_example,
-            no_info_form_prompt_example=no_info_form_prompt_example,
-            trial_lesson_invite_example=trial_lesson_invite_example,
-            post_consultation_prompt_example=post_consultation_prompt_example,
-            cooperation_contact_prompt_example=cooperation_contact_prompt_example
+        return load_prompt_template(lang_code).format(
+            knowledge_base=messages['prompt_kb_ref'],
+            courses_str=messages['prompt_courses_ref'],
+            off_topic_response_example=messages['off_topic_response'],
+            enrollment_form_prompt_example=messages['enrollment_form_prompt'],
+            no_info_form_prompt_example=messages['no_info_form_prompt'],
+            trial_lesson_invite_example=messages['trial_lesson_invite'],
+            post_consultation_prompt_example=messages['post_consultation_prompt'],
+            cooperation_contact_prompt_example=messages['cooperation_contact_prompt']
         )
     except KeyError as e:
         logger.error(
             f"Ошибка форматирования промпта для языка {lang_code}: не найден ключ {e}. Проверьте файл промпта.")
-        prompt = (
+        return (
             "You are an IT Run Academy virtual manager. Provide information about courses and academy. "
-            f"Knowledge Base: {knowledge_base}\nCourses: {courses_str}\n"
-            "If information is missing, ask to fill the form."
+            "Use the knowledge base and course info below. If information is missing, ask to fill the form."
         )
-    return prompt
 
 
-async def get_gpt_response(user_message, chat_history, lang_code):
-    messages = [{"role": "system", "content": get_system_prompt(lang_code)}]
-    messages.extend(chat_history)
+def render_dynamic_prompt(lang_code, knowledge_base, courses_str):
+    """Рендерит изменяемый хвост промпта: базу знаний и список курсов."""
+    messages = MESSAGES[lang_code]
+    return (
+        f"\n\n{messages['prompt_kb_title']}\n{knowledge_base}\n"
+        f"{messages['prompt_courses_title']}\n{courses_str}\n"
+    )
+
+
+def prompt_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+
+
+def render_system_prompt(lang_code):
+    """Собирает системный промпт для языка и кладет его в prompt_cache."""
+    knowledge_base = knowledge_base_cache.get(lang_code, '')
+    if not knowledge_base:
+        logger.error(f"База знаний для языка {lang_code} пуста в кэше.")
+        knowledge_base = "Информация об академии временно недоступна."
+
+    prefix = render_static_prompt(lang_code)
+    text = prefix + render_dynamic_prompt(lang_code, knowledge_base, build_courses_str(lang_code))
+    entry = {
+        'text': text,
+        'prefix': prefix,
+        'version': prompt_hash(text),
+        'prefix_version': prompt_hash(prefix),
+    }
+    prompt_cache[lang_code] = entry
+    return entry
+
+
+def rebuild_prompt_cache():
+    """Перестраивает промпты для всех языков после загрузки новых данных."""
+    for lang in ['ru', 'ky']:
+        old_version = prompt_cache.get(lang, {}).get('version')
+        entry = render_system_prompt(lang)
+        if entry['version'] != old_version:
+            logger.info(f"Промпт для {lang} обновлен: версия {entry['version']}, "
+                        f"префикс {entry['prefix_version']}, {len(entry['text'])} символов.")
+
 
-    MAX_HISTORY_LENGTH = 10
-    if len(messages) > MAX_HISTORY_LENGTH + 1:
-        messages = [messages[0]] + messages[-(MAX_HISTORY_LENGTH):]
+# Индексы для поиска по базе знаний и курсам: lang -> RetrievalIndex
+retrieval_index = {}
 
+
+def rebuild_retrieval_index():
+    """Перестраивает поисковые индексы после загрузки новых данных."""
+    for lang in ['ru', 'ky']:
+        retrieval_index[lang] = build_index(
+            knowledge_base_cache.get(lang, ''),
+            [format_course_line(c) for c in course_cache.get(lang, [])],
+            synonyms=COURSE_SYNONYMS.get(lang),
+            max_chars=RETRIEVAL_CHUNK_CHARS,
+        )
+        logger.info(f"Поисковый индекс для {lang}: {len(retrieval_index[lang].chunks)} фрагментов.")
+
+
+# Индексы быстрых ответов по курсам: lang -> CourseLookup
+course_lookup = {}
+
+
+def rebuild_course_lookup():
+    for lang in ['ru', 'ky']:
+        course_lookup[lang] = CourseLookup(
+            course_cache.get(lang, []),
+            synonyms=COURSE_SYNONYMS.get(lang),
+            max_words=COURSE_FAST_PATH_MAX_WORDS,
+        )
+
+
+def get_course_fast_answer(user_message, lang_code):
+    """Шаблонный ответ из таблицы курсов или None, если вопрос нужно отдать GPT."""
+    lookup = course_lookup.get(lang_code)
+    match = lookup.match(user_message) if lookup else None
+    if match is None:
+        return None
+    course, fields = match
+    messages = MESSAGES[lang_code]
+    lines = [messages['course_fast_header'].format(name=course['Название курса'])]
+    for field in fields:
+        lines.append("• " + messages[f'course_field_{field}'].format(value=course[COURSE_FIELDS[field]]))
+    lines.append("")
+    lines.append(messages['post_consultation_prompt'])
+    return "\n".join(lines)
+
+
+def get_retrieval_prompt(lang_code, query):
+    """Промпт только с релевантными запросу фрагментами или None, если ничего не найдено.
+
+    Если нашлись только строки курсов, база знаний в промпт не добавляется: на
+    вопрос отвечает строка курса. Если только фрагменты базы знаний, добавляется
+    весь список курсов: он короткий, а GPT часто предлагает подходящий курс.
+    """
+    index = retrieval_index.get(lang_code)
+    if index is None:
+        return None
+    hits = index.search(query, k=RETRIEVAL_TOP_K, min_score=RETRIEVAL_MIN_SCORE)
+    if not hits:
+        return None
+    kb_chunks = [text for _, kind, text in hits if kind == 'kb']
+    course_lines = [text for _, kind, text in hits if kind == 'course']
+    knowledge_base = "\n...\n".join(kb_chunks) or MESSAGES[lang_code]['prompt_kb_not_needed']
+    courses_str = "\n".join(course_lines) or build_courses_str(lang_code)
+    prefix = get_cached_prompt(lang_code)['prefix']
+    return prefix + render_dynamic_prompt(lang_code, knowledge_base, courses_str)
+
+
+def get_cached_prompt(lang_code):
+    entry = prompt_cache.get(lang_code)
+    if entry is None:
+        entry = render_system_prompt(lang_code)
+    return entry
+
+
+def get_system_prompt(lang_code, query=None):
+    """Возвращает готовый промпт из кэша без обращения к диску и форматирования.
+
+    При включенном RETRIEVAL_ENABLED и переданном запросе в промпт попадают только
+    релевантные фрагменты; если поиск ничего не нашел, используется полный промпт.
+    """
+    if RETRIEVAL_ENABLED and query:
+        prompt = get_retrieval_prompt(lang_code, query)
+        if prompt is not None:
+            return prompt
+    return get_cached_prompt(lang_code)['text']
+
+
+def build_gpt_messages(user_message, chat_history, lang_code):
+    # Запрос для поиска: текущее сообщение и предыдущий вопрос пользователя для контекста
+    recent_questions = [m['content'] for m in chat_history if m['role'] == 'user'][-1:]
+    query = " ".join(recent_questions + [user_message])
+    with metrics.timer('prompt_build'):
+        system_prompt = get_system_prompt(lang_code, query)
+    messages = [{"role": "system", "content": system_prompt}]
+    # История уже ограничена бюджетом токенов в ConversationMemory
+    messages.extend(chat_history)
     messages.append({"role": "user", "content": user_message})
 
-    logger.info(f"Сообщения для GPT: {messages}")
+    if LOG_PROMPT_SAMPLE_RATE and random.random() < LOG_PROMPT_SAMPLE_RATE and logger.isEnabledFor(logging.INFO):
+        logger.info("Сообщения для GPT: %s", describe_messages(messages))
+    return messages
 
+
+def openai_error_message(e, lang_code):
+    """Подбирает сообщение пользователю по ошибке OpenAI."""
+    logger.error(f"Ошибка OpenAI: {str(e)}", exc_info=True)
+    if isinstance(e, RateLimitError) or "rate limit" in str(e).lower():
+        return MESSAGES[lang_code]['openai_rate_limit_error']
+    elif "authentication error" in str(e).lower() or "invalid api key" in str(e).lower():
+        return MESSAGES[lang_code]['openai_auth_error']
+    elif isinstance(e, APITimeoutError) or "timeout" in str(e).lower():
+        return MESSAGES[lang_code]['openai_timeout_error']
+    return MESSAGES[lang_code]['openai_unknown_error']
+
+
+def retry_after_seconds(e):
+    """Значение заголовка Retry-After из ответа 429, если он есть."""
+    response = getattr(e, 'response', None)
     try:
-        response = await asyncio.to_thread(
-            openai_client.chat.completions.create,
-            model="gpt-4o",
-            messages=messages,
-            max_tokens=500,
-            temperature=0.7
-        )
-        return response.choices[0].message.content
+        return float(response.headers.get('retry-after'))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+@contextlib.asynccontextmanager
+async def chat_completion(messages, priority, **kwargs):
+    """Запрос к GPT через очередь допуска, лимит параллельности и повторы при 429 и таймаутах.
+
+    priority 0 — пользователь уже в диалоге, 1 — новый; слот удерживается, пока
+    выполняется тело блока (важно для потоковой выдачи).
+    """
+    prompt_tokens = sum(estimate_tokens(m['content']) for m in messages)
+    attempt = 0
+    while True:
+        # Модель выбираем до очереди: ожидание основной модели уже не вернуть,
+        # а у резервной свои лимиты и своя очередь
+        model, admission = OPENAI_MODEL, chat_admission
+        tokens = admission.cost(prompt_tokens, OPENAI_MAX_TOKENS)
+        if OPENAI_FALLBACK_MODEL:
+            expected = chat_admission.expected_wait(tokens, priority)
+            if expected > OPENAI_DEGRADE_WAIT:
+                model, admission = OPENAI_FALLBACK_MODEL, fallback_admission
+                tokens = admission.cost(prompt_tokens, OPENAI_MAX_TOKENS)
+                chat_admission.degraded += 1
+                logger.warning(f"Ожидание {OPENAI_MODEL} около {expected:.2f} с, запрос переключен на {model}")
+        wait = await admission.admit(tokens, priority)
+        async with chat_governor.slot() as slot_wait:
+            wait += slot_wait
+            if wait > 1:
+                logger.warning(f"Запрос к {model} ждал в очереди {wait:.2f} с, {admission.stats()}")
+            try:
+                with metrics.timer('openai_chat'):
+                    response = await openai_client.chat.completions.create(
+                        model=model,
+                        messages=messages,
+                        max_tokens=OPENAI_MAX_TOKENS,
+                        temperature=0.7,
+                        **kwargs
+                    )
+            except (RateLimitError, APITimeoutError) as e:
+                metrics.inc('openai_chat_retryable_errors')
+                if attempt >= OPENAI_MAX_RETRIES:
+                    raise
+                delay = backoff_delay(attempt, retry_after=retry_after_seconds(e))
+                error_name = type(e).__name__
+                if isinstance(e, RateLimitError):
+                    admission.pause(delay)
+            else:
+                metrics.inc('openai_chat_requests')
+                metrics.observe('openai_queue_wait', wait)
+                # В потоковом режиме usage нет, калибруемся по обычным ответам
+                usage = getattr(response, 'usage', None)
+                if usage is not None:
+                    admission.calibrate(prompt_tokens, usage.prompt_tokens)
+                yield response
+                return
+        attempt += 1
+        admission.retries += 1
+        logger.warning(f"OpenAI: {error_name}, повтор {attempt}/{OPENAI_MAX_RETRIES} через {delay:.2f} с")
+        await asyncio.sleep(delay)
+
+
+async def get_gpt_response(user_message, chat_history, lang_code):
+    messages = build_gpt_messages(user_message, chat_history, lang_code)
+
+    try:
+        async with chat_completion(messages, priority=0 if chat_history else 1) as response:
+            usage = getattr(response, 'usage', None)
+            if usage is not None:
+                metrics.inc('gpt_prompt_tokens', usage.prompt_tokens)
+                metrics.inc('gpt_completion_tokens', usage.completion_tokens)
+            return response.choices[0].message.content
+    except Exception as e:
+        return openai_error_message(e, lang_code)
+
+
+async def edit_reply(reply, text):
+    """Редактирует сообщение, пропуская ошибки лимитов и неизмененного текста."""
+    try:
+        await reply.edit_text(text)
+        return True
+    except RetryAfter as e:
+        logger.warning(f"Telegram ограничил редактирование сообщения, ожидание {e.retry_after} с")
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            logger.error(f"Ошибка редактирования сообщения: {e}")
+    return False
+
+
+async def stream_gpt_response(message, user_message, chat_history, lang_code):
+    """Стримит ответ GPT в Telegram: заглушка с первыми токенами и редкие правки.
+
+    Возвращает полный текст ответа для истории диалога. Сообщение об ошибке
+    OpenAI заменяет ответ только при сбое самого потока; если не удалась отправка
+    в Telegram, ответ дочитывается и отправляется целиком в конце.
+    """
+    messages = build_gpt_messages(user_message, chat_history, lang_code)
+    reply = None
+    text = ""
+    shown = ""
+    last_edit = 0.0
+    telegram_failed = False
+
+    try:
+        async with chat_completion(messages, priority=0 if chat_history else 1, stream=True) as stream:
+            # _Timer синхронный, поэтому не в одном async with с потоком
+            with metrics.timer('openai_chat_stream'):
+                async for chunk in stream:
+                    if not chunk.choices:
+                        continue
+                    text += chunk.choices[0].delta.content or ""
+                    if not text.strip() or telegram_failed:
+                        continue
+                    now = time.monotonic()
+                    try:
+                        if reply is None:
+                            reply = await message.reply_text(text + STREAM_CURSOR)
+                            shown, last_edit = text, now
+                        elif now - last_edit >= STREAM_EDIT_INTERVAL and len(text) - len(shown) >= STREAM_MIN_CHARS:
+                            # Время отмечаем до запроса, чтобы ошибки лимитов тоже выдерживали паузу
+                            last_edit = now
+                            if await edit_reply(reply, text + STREAM_CURSOR):
+                                shown = text
+                    except TelegramError as e:
+                        telegram_failed = True
+                        logger.warning(f"Ошибка Telegram при потоковой выдаче, ответ будет отправлен целиком: {e}")
+        # В потоковом режиме usage не приходит, поэтому токены оцениваем по длине текста
+        metrics.inc('gpt_prompt_tokens', sum(estimate_tokens(m['content']) for m in messages))
+        metrics.inc('gpt_completion_tokens', estimate_tokens(text))
     except Exception as e:
-        logger.error(f"Ошибка OpenAI: {str(e)}", exc_info=True)
-        if "rate limit" in str(e).lower():
-            return MESSAGES[lang_code]['openai_rate_limit_error']
-        elif "authentication error" in str(e).lower() or "invalid api key" in str(e).lower():
-            return MESSAGES[lang_code]['openai_auth_error']
-        elif "timeout" in str(e).lower():
-            return MESSAGES[lang_code]['openai_timeout_error']
-        return MESSAGES[lang_code]['openai_unknown_error']
+        text = openai_error_message(e, lang_code)
+
+    if reply is None:
+        await message.reply_text(text)
+    else:
+        # Финальная правка без курсора; при лимите Telegram ждем и повторяем один раз
+        try:
+            await reply.edit_text(text)
+        except RetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+            await edit_reply(reply, text)
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                logger.error(f"Ошибка финального редактирования сообщения: {e}")
+    return text
+
+
+answer_cache = AnswerCache(max_size=ANSWER_CACHE_SIZE, ttl_seconds=ANSWER_CACHE_TTL.total_seconds())
+# Синонимы курсов для нормализации вопросов: lang -> [(шаблон, каноничное название)]
+answer_cache_synonyms = {lang: compile_synonyms(synonyms) for lang, synonyms in COURSE_SYNONYMS.items()}
+ERROR_RESPONSES = {
+    text for messages in MESSAGES.values()
+    for key, text in messages.items() if key.startswith('openai_')
+}
+
+
+def answer_cache_key(user_message, lang_code):
+    """Ключ кэша: язык, нормализованный вопрос и версия данных, из которых собран промпт."""
+    normalized = normalize_question(user_message, answer_cache_synonyms.get(lang_code, ()))
+    if not normalized:
+        return None
+    return lang_code, normalized, get_cached_prompt(lang_code)['version']
+
+
+def get_memory(user_data):
+    """Возвращает память диалога пользователя, создавая ее при первом обращении."""
+    memory = user_data.get('memory')
+    if memory is None:
+        memory = ConversationMemory(
+            token_budget=HISTORY_TOKEN_BUDGET,
+            max_turns=HISTORY_MAX_TURNS,
+            summary_max_chars=HISTORY_SUMMARY_CHARS,
+        )
+        user_data['memory'] = memory
+    return memory
+
+
+def user_language(user_data):
+    """Текущий язык ответов пользователю; до первого сообщения — русский."""
+    state = user_data.get('language')
+    return state.lang if state is not None else 'ru'
+
+
+def observe_language(user_data, text, prior=None):
+    """Учитывает язык сообщения в состоянии пользователя и возвращает язык ответа.
+
+    prior — язык интерфейса Telegram, нужен только пока состояния еще нет.
+    """
+    state = user_data.get('language')
+    if state is None:
+        state = user_data['language'] = LanguageState.from_first_message(text, prior)
+        logger.debug("Начальный язык %s (оценка %.2f): '%s'", state.lang, state.balance, shorten(text))
+    elif text and state.observe(text):
+        logger.info(f"Язык ответов переключен на {state.lang} (баланс {state.balance:.2f}).")
+    return state.lang
+
+
+def dump_user_data(user_data):
+    """user_data в JSON-словарь для хранилища состояния."""
+    data = {key: value for key, value in user_data.items() if key not in ('memory', 'language')}
+    memory = user_data.get('memory')
+    if memory is not None:
+        data['memory'] = memory.to_dict()
+    language = user_data.get('language')
+    if language is not None:
+        data['language'] = language.to_dict()
+    return data
+
+
+def restore_user_data(data):
+    """Обратное к dump_user_data: восстанавливает память диалога с текущими лимитами."""
+    user_data = dict(data)
+    if 'language' in user_data:
+        user_data['language'] = LanguageState.from_dict(user_data['language'])
+    elif 'lang' in user_data:
+        # Записи до появления LanguageState хранили только код языка
+        user_data['language'] = LanguageState(user_data.pop('lang'))
+    if 'memory' in user_data:
+        user_data['memory'] = ConversationMemory.from_dict(
+            user_data['memory'],
+            token_budget=HISTORY_TOKEN_BUDGET,
+            max_turns=HISTORY_MAX_TURNS,
+            summary_max_chars=HISTORY_SUMMARY_CHARS,
+        )
+    return user_data
+
+
+async def evict_idle_users_job(context: ContextTypes.DEFAULT_TYPE):
+    """Удаляет данные пользователей, неактивных дольше USER_IDLE_TTL, и пишет объем памяти."""
+    application = context.application
+    ttl = USER_IDLE_TTL.total_seconds()
+    now = time.time()
+    evicted = 0
+    total_bytes = 0
+    largest = (None, 0)
+    for user_id, user_data in list(application.user_data.items()):
+        memory = user_data.get('memory')
+        if memory is None:
+            continue
+        if memory.is_idle(ttl, now):
+            application.drop_user_data(user_id)
+            evicted += 1
+            continue
+        size = memory.size_bytes()
+        total_bytes += size
+        if size > largest[1]:
+            largest = (user_id, size)
+    logger.info(f"Память диалогов: удалено неактивных {evicted}, активных {len(application.user_data)}, "
+                f"всего {total_bytes / 1024:.1f} КБ, максимум {largest[1] / 1024:.1f} КБ у {largest[0]}")
+    if application.persistence is not None:
+        # В хранилище остаются и те, кто с момента запуска не писал этому процессу
+        pruned = await application.persistence.prune()
+        if pruned:
+            logger.info(f"Из хранилища состояния удалено устаревших записей: {pruned}")
+
+
+chat_dispatcher = ChatDispatcher(debounce=MESSAGE_DEBOUNCE_SECONDS, max_pending=CHAT_MAX_PENDING)
+
+
+def chat_key(update: Update):
+    """Ключ очереди: чат и пользователь, чтобы в группах не смешивать разных людей."""
+    return update.effective_chat.id, update.effective_user.id
+
+
+async def reply_chat_busy(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    logger.warning(f"Очередь чата {chat_key(update)} переполнена, сообщение отклонено.")
+    await update.message.reply_text(MESSAGES[user_language(context.user_data)]['chat_busy'])
 
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await refresh_cache()
-    lang_code = detect_language(update.message.text)
-    context.user_data['lang'] = lang_code
-    context.user_data['chat_history'] = []
+    refresh_coordinator.refresh_in_background()
+    try:
+        async with chat_dispatcher.serialized(chat_key(update)):
+            # В "/start" нет текста: язык берется из состояния или из языка интерфейса Telegram
+            lang_code = observe_language(context.user_data, "", update.effective_user.language_code)
+            get_memory(context.user_data).clear()
+    except ChatBusy:
+        await reply_chat_busy(update, context)
+        return
     logger.info(f"Запуск команды /start для пользователя {update.effective_user.id}, язык: {lang_code}")
     await update.message.reply_text(MESSAGES[lang_code]['welcome'])
 
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, message_text: str = None):
+    with metrics.timer('handle_message'):
+        await answer_message(update, context, message_text)
+
+
+async def answer_message(update: Update, context: ContextTypes.DEFAULT_TYPE, message_text: str = None):
     # Если message_text передан (например, из голосового сообщения), используем его.
     # В противном случае, используем текст из update.message.
     user_message = message_text if message_text is not None else update.message.text.strip()
     user_id = update.effective_user.id
 
-    # Определяем язык, используя либо уже установленный в user_data, либо детектируя из сообщения
-    lang_code = context.user_data.get('lang', detect_language(user_message))
-    logger.info(f"Обработка сообщения от {user_id}: '{user_message}', язык: {lang_code}")
-
-    if 'chat_history' not in context.user_data:
-        context.user_data['chat_history'] = []
-    if 'lang' not in context.user_data:
-        context.user_data['lang'] = lang_code
-
-    chat_history = context.user_data.get('chat_history', [])
-    chat_history.append({"role": "user", "content": user_message})
-
-    await update.message.reply_chat_action("typing")
+    # Язык ответа меняется только при устойчивом переходе пользователя на другой язык
+    with metrics.timer('language_detection'):
+        lang_code = observe_language(context.user_data, user_message, update.effective_user.language_code)
+    logger.info("Обработка сообщения от %s: '%s', язык: %s", user_id, shorten(user_message), lang_code)
+
+    memory = get_memory(context.user_data)
+    chat_history = memory.as_messages()
+
+    with metrics.timer('cache_check'):
+        fast_response = get_course_fast_answer(user_message, lang_code) if COURSE_FAST_PATH else None
+
+        # Кэшируем только вопросы без контекста диалога: ответ на них не зависит от истории
+        cache_key = None
+        if fast_response is None and ANSWER_CACHE_ENABLED and not chat_history:
+            cache_key = answer_cache_key(user_message, lang_code)
+        cached_response = answer_cache.get(cache_key) if cache_key else None
+
+    if fast_response is not None:
+        logger.info(f"Ответ для {user_id} сформирован из таблицы курсов без GPT.")
+        metrics.inc('course_fast_path_answers')
+        response_text = fast_response
+        with metrics.timer('telegram_send'):
+            await update.message.reply_text(response_text)
+    elif cached_response is not None:
+        logger.info(f"Ответ для {user_id} взят из кэша ответов.")
+        response_text = cached_response
+        with metrics.timer('telegram_send'):
+            await update.message.reply_text(response_text)
+    else:
+        await update.message.reply_chat_action("typing")
+        if STREAM_REPLIES:
+            response_text = await stream_gpt_response(update.message, user_message, chat_history, lang_code)
+        else:
+            response_text = await get_gpt_response(user_message, chat_history, lang_code)
+            with metrics.timer('telegram_send'):
+                await update.message.reply_text(response_text)
+        if cache_key and response_text not in ERROR_RESPONSES:
+            answer_cache.put(cache_key, response_text)
+
+    memory.add("user", user_message)
+    memory.add("assistant", response_text)
+
+
+async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Ставит текстовое сообщение в очередь чата; быстрые сообщения подряд уходят в GPT одним запросом."""
+    async def process(batch):
+        if len(batch) > 1:
+            logger.info(f"Объединено {len(batch)} сообщений от {update.effective_user.id} в один запрос.")
+        # Отвечаем на последнее сообщение пачки
+        await handle_message(batch[-1][0], context, message_text="\n".join(text for _, text in batch))
 
-    response_text = await get_gpt_response(user_message, chat_history, lang_code)
-    chat_history.append({"role": "assistant", "content": response_text})
-    context.user_data['chat_history'] = chat_history
+    try:
+        await chat_dispatcher.submit(chat_key(update), (update, update.message.text.strip()), process)
+    except ChatBusy:
+        await reply_chat_busy(update, context)
+
+
+
+# Форматы, которые Whisper принимает без перекодирования: MIME-тип -> расширение файла
+WHISPER_FORMATS = {
+    'audio/ogg': 'ogg',
+    'audio/opus': 'ogg',
+    'audio/mpeg': 'mp3',
+    'audio/mp4': 'm4a',
+    'audio/x-m4a': 'm4a',
+    'audio/wav': 'wav',
+    'audio/x-wav': 'wav',
+    'audio/webm': 'webm',
+    'audio/flac': 'flac',
+}
+WHISPER_PROMPT = "Салам алейкум, курстар, Python, Backend, Frontend, Scratch, IT Run Academy, Жалал-Абад, салам, жакшы, рахмат, программирование, курс, как дела, здравствуйте, до свидания"
+
+# Кэш расшифровок по file_unique_id: пересланные и повторные голосовые не расшифровываются заново
+transcription_cache = AnswerCache(max_size=TRANSCRIPTION_CACHE_SIZE, ttl_seconds=TRANSCRIPTION_CACHE_TTL.total_seconds())
+voice_process_pool = None
+
+
+def get_voice_process_pool():
+    """Пул процессов для конвертации аудио, создается при первой необходимости.
+
+    Где есть forkserver, рабочие процессы порождаются от чистого сервера с
+    предзагруженным voice_convert, а не копией процесса бота с его потоками
+    и соединениями, как при fork. В Windows доступен только spawn.
+    """
+    global voice_process_pool
+    if voice_process_pool is None:
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('forkserver')
+            context.set_forkserver_preload(['voice_convert'])
+        else:
+            context = multiprocessing.get_context('spawn')
+        voice_process_pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=VOICE_CONVERT_WORKERS, mp_context=context)
+    return voice_process_pool
+
+
+async def transcribe_voice(voice, bot):
+    """Скачивает голосовое в память и расшифровывает его через Whisper."""
+    cached = transcription_cache.get(voice.file_unique_id)
+    if cached is not None:
+        logger.info(f"Расшифровка голосового {voice.file_unique_id} взята из кэша.")
+        return cached
+
+    with metrics.timer('voice_download'):
+        voice_file = await bot.get_file(voice.file_id)
+        data = bytes(await voice_file.download_as_bytearray())
+    mime_type = voice.mime_type or 'audio/ogg'
+    extension = WHISPER_FORMATS.get(mime_type)
+    if extension is None:
+        # Неподдерживаемый формат конвертируем в отдельном процессе, не блокируя event loop
+        loop = asyncio.get_running_loop()
+        with metrics.timer('ffmpeg_conversion'):
+            data = await loop.run_in_executor(
+                get_voice_process_pool(), convert_to_mp3, data, mime_type.split('/')[-1])
+        extension = 'mp3'
+        logger.info(f"Голосовое сообщение ({mime_type}) конвертировано в MP3.")
+
+    async with transcription_governor.slot():
+        with metrics.timer('openai_whisper'):
+            transcription_response = await openai_client.audio.transcriptions.create(
+                model="whisper-1",
+                file=(f"voice.{extension}", data),
+                response_format="text",
+                prompt=WHISPER_PROMPT
+            )
+    text = transcription_response.strip()
+    if text:
+        transcription_cache.put(voice.file_unique_id, text)
+    return text
 
-    await update.message.reply_text(response_text)
 
+def log_typing_error(task):
+    """Ошибка статуса "печатает" не мешает ответу, ее достаточно записать в лог."""
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning(f"Не удалось отправить статус набора: {task.exception()}")
 
 
-# НОВЫЙ ХЕНДЛЕР ДЛЯ ГОЛОСОВЫХ СООБЩЕНИЙ
 async def handle_voice_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    voice_file_id = update.message.voice.file_id
-    logger.info(f"Получено голосовое сообщение от {user_id}, file_id: {voice_file_id}")
-
-    await update.message.reply_chat_action("typing")
-
-    ogg_path = None
-    mp3_path = None
+    voice = update.message.voice
+    logger.info(f"Получено голосовое сообщение от {user_id}, file_id: {voice.file_id}")
+
+    # Место в очереди чата занимаем по приходу голосового, до первого await: текст,
+    # отправленный после него, не получит ответ раньше. Статус "печатает" и расшифровка
+    # идут параллельно с ожиданием очереди
+    typing = asyncio.ensure_future(update.message.reply_chat_action("typing"))
+    typing.add_done_callback(log_typing_error)
+    transcription = asyncio.ensure_future(transcribe_voice(voice, context.bot))
     try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".ogg") as temp_ogg_file:
-            ogg_path = temp_ogg_file.name
-            voice_file = await context.bot.get_file(voice_file_id)
-            await voice_file.download_to_drive(ogg_path)
-        logger.info(f"Голосовое сообщение сохранено во временный файл: {ogg_path}")
-
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".mp3") as temp_mp3_file:
-            mp3_path = temp_mp3_file.name
+        async with chat_dispatcher.serialized(chat_key(update)):
             try:
-                audio = AudioSegment.from_file(ogg_path, format="ogg")
-                audio.export(mp3_path, format="mp3")
-                logger.info(f"Голосовое сообщение конвертировано в MP3: {mp3_path}")
-            except Exception as e:
-                logger.error(f"Ошибка конвертации OGG в MP3 с помощью pydub/ffmpeg: {e}", exc_info=True)
+                user_message_text = await transcription
+            except (OSError, AudioConversionError) as e:
+                logger.error(f"Ошибка конвертации аудио с помощью pydub/ffmpeg: {e}", exc_info=True)
                 await update.message.reply_text(
                     "Извините, произошла ошибка при обработке аудио. Пожалуйста, попробуйте еще раз или напишите мне.")
                 return
+            logger.info("Голосовое сообщение транскрибировано в текст: '%s'", shorten(user_message_text))
 
-                # ... (код до этого места остается без изменений) ...
-
-            with open(mp3_path, "rb") as audio_file:
-                    transcription_response = await asyncio.to_thread(
-                        openai_client.audio.transcriptions.create,
-                        model="whisper-1",
-                        file=audio_file,
-                        response_format="text",
-                        # УДАЛИТЕ language="ru" или language="ky" ЕСЛИ ОНО ТАМ ЕЩЕ ЕСТЬ
-                        # ДОБАВЬТЕ ПАРАМЕТР PROMPT С КЫРГЫЗСКИМИ И РУССКИМИ СЛОВАМИ
-                        prompt="Салам алейкум, курстар, Python, Backend, Frontend, Scratch, IT Run Academy, Жалал-Абад, салам, жакшы, рахмат, программирование, курс, как дела, здравствуйте, до свидания"
-                    )
-
-            user_message_text = transcription_response.strip()
-            logger.info(f"Голосовое сообщение транскрибировано в текст: '{user_message_text}'")
-
-        # ... (остальной код handle_voice_message без изменений) ...
-
-        if not user_message_text:
-            await update.message.reply_text(
-                "Извините, не удалось распознать речь в вашем сообщении. Пожалуйста, повторите или напишите мне.")
-            return
-
-        # *** ВАЖНОЕ ИЗМЕНЕНИЕ: Обновляем язык в user_data на основе распознанного текста ***
-        detected_lang = detect_language(user_message_text)
-        context.user_data['lang'] = detected_lang # Перезаписываем язык в контексте пользователя
-        logger.info(f"Язык для ответа установлен на: {detected_lang} (на основе голосового сообщения)")
-
+            if not user_message_text:
+                await update.message.reply_text(
+                    "Извините, не удалось распознать речь в вашем сообщении. Пожалуйста, повторите или напишите мне.")
+                return
 
-        # Передаем распознанный текст в существующий обработчик текстовых сообщений
-        await handle_message(update, context, message_text=user_message_text)
+            # Передаем распознанный текст в существующий обработчик текстовых сообщений,
+            # язык расшифровки учитывается там же, с гистерезисом, как у текста
+            await handle_message(update, context, message_text=user_message_text)
 
+    except ChatBusy:
+        await reply_chat_busy(update, context)
     except Exception as e:
         logger.exception("Ошибка при обработке голосового сообщения:")
         await update.message.reply_text(
             "Извините, произошла ошибка при обработке вашего голосового сообщения. Пожалуйста, попробуйте еще раз или напишите мне.")
     finally:
-        if ogg_path and os.path.exists(ogg_path):
-            os.remove(ogg_path)
-            logger.info(f"Временный файл удален: {ogg_path}")
-        if mp3_path and os.path.exists(mp3_path):
-            os.remove(mp3_path)
-            logger.info(f"Временный файл удален: {mp3_path}")
-
+        # Если до расшифровки дело не дошло (ChatBusy, отмена), не расходуем на нее запрос
+        transcription.cancel()
 
 
+metrics.register_gauges('answer_cache', answer_cache.stats)
+metrics.register_gauges('transcription_cache', transcription_cache.stats)
+metrics.register_gauges('admission', chat_admission.stats)
+metrics.register_gauges('fallback_admission', fallback_admission.stats)
+metrics.register_gauges('chat_governor', chat_governor.stats)
+metrics.register_gauges('transcription_governor', transcription_governor.stats)
+metrics.register_gauges('chat_dispatcher', chat_dispatcher.stats)
+metrics.register_gauges('refresh', refresh_coordinator.stats)
+metrics.register_gauges('startup', startup_timer.stats)
 
-def detect_language(text):
-    text_lower = text.lower()
-    kyrgyz_keywords = [
-        'ооба', 'жок', 'салам', 'жазылайын', 'катталуу', 'тиркеме', 'кабыл алуу', 'кантип', 'эмне',
-        'ким', 'бекенд', 'фронтенд', 'графолог', 'мобилография', 'орт', 'программист', 'баасы', 'узактыгы', 'графиги'
-    ]
 
-    kyrgyz_chars = "ңөү"
-    if any(char in text_lower for char in kyrgyz_chars):
-        logger.info(f"Язык определен как KY (по кыргызским буквам): '{text}'")
-        return 'ky'
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Сводка метрик с перцентилями для администраторов (ADMIN_USER_IDS)."""
+    if update.effective_user.id not in ADMIN_USER_IDS:
+        return
+    await update.message.reply_text(metrics.summary())
 
-    kyrgyz_word_count = sum(1 for keyword in kyrgyz_keywords if keyword in text_lower)
 
-    if kyrgyz_word_count > 0 or "саламатсызбы" in text_lower:
-        logger.info(f"Язык определен как KY (по ключевым словам): '{text}')")
-        return 'ky'
-
-    logger.info(f"Язык определен как RU (по умолчанию): '{text}')")
-    return 'ru'
+async def serve_metrics(reader, writer):
+    """Минимальный HTTP-ответ с метриками в текстовом формате Prometheus на любой запрос."""
+    try:
+        await reader.readuntil(b"\r\n\r\n")
+        body = metrics.render_prometheus().encode('utf-8')
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            + f"Content-Length: {len(body)}\r\n".encode('ascii')
+            + b"Connection: close\r\n\r\n"
+            + body
+        )
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def post_init(application: Application):
+    if METRICS_PORT:
+        application.bot_data['metrics_server'] = await asyncio.start_server(serve_metrics, port=METRICS_PORT)
+        logger.info(f"Метрики Prometheus доступны на порту {METRICS_PORT}.")
+    startup_timer.mark('telegram')
+    logger.info(f"Бот готов принимать сообщения через {time.monotonic() - PROCESS_STARTED:.2f} с после запуска процесса "
+                f"({startup_timer.summary()}).")
+
+
+def create_bot():
+    """Bot без Application: нужен маршрутизатору только для регистрации webhook."""
+    if TELEGRAM_API_BASE_URL:
+        return Bot(TELEGRAM_BOT_TOKEN, base_url=f"{TELEGRAM_API_BASE_URL}/bot",
+                   base_file_url=f"{TELEGRAM_API_BASE_URL}/file/bot")
+    return Bot(TELEGRAM_BOT_TOKEN)
+
+
+async def register_webhook(bot):
+    await bot.set_webhook(url=f"{WEBHOOK_URL}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET,
+                          allowed_updates=Update.ALL_TYPES)
+    logger.info(f"Webhook зарегистрирован: {WEBHOOK_URL}{WEBHOOK_PATH}")
+
+
+def stop_event_on_signals():
+    """Событие, которое выставляют SIGINT и SIGTERM (вместо sys.exit из signal_handler)."""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    return stop
+
+
+async def run_webhook(application: Application):
+    """Webhook-режим: апдейты приходят на встроенный HTTP-сервер и ставятся в очередь приложения."""
+    stop = stop_event_on_signals()
+
+    async def enqueue(data):
+        await application.update_queue.put(Update.de_json(data, application.bot))
+
+    server = WebhookServer(enqueue, WEBHOOK_PATH, WEBHOOK_SECRET)
+    metrics.register_gauges('webhook', server.stats)
+    async with application:
+        await post_init(application)
+        await application.start()
+        try:
+            await server.start(WEBHOOK_LISTEN, WEBHOOK_PORT)
+            if WEBHOOK_URL:
+                await register_webhook(application.bot)
+            await stop.wait()
+            logger.info('Получен сигнал завершения, останавливаем бот...')
+        finally:
+            await server.stop()
+            await application.stop()
+    await post_shutdown(application)
+
+
+async def run_webhook_router():
+    """Принимает webhook и пересылает каждый апдейт воркеру, который отвечает за его чат."""
+    stop = stop_event_on_signals()
+    router = UpdateRouter(WEBHOOK_WORKERS, WEBHOOK_PATH, WEBHOOK_SECRET)
+    server = WebhookServer(router.forward, WEBHOOK_PATH, WEBHOOK_SECRET)
+    await server.start(WEBHOOK_LISTEN, WEBHOOK_PORT)
+    try:
+        if WEBHOOK_URL:
+            async with create_bot() as bot:
+                await register_webhook(bot)
+        logger.info(f"Маршрутизатор webhook запущен, воркеров: {len(WEBHOOK_WORKERS)}")
+        await stop.wait()
+    finally:
+        await server.stop()
+        await router.close()
+        logger.info(f"Маршрутизатор остановлен: {server.stats()}, {router.stats()}")
 
 
-def main():
+def load_initial_data():
+    """Загружает курсы и базу знаний из локального снимка, а без него — из Google."""
     logger.info("Инициализация: загрузка курсов и базы знаний.")
+    started = time.monotonic()
+    if refresh_coordinator.load_snapshot():
+        # Данные из снимка отдаются сразу, а клиенты Google создаст и проверит данные фоновое обновление
+        logger.info(f"Данные загружены из локального снимка за {(time.monotonic() - started) * 1000:.0f} мс.")
+        return
     try:
-        load_courses_from_sheets()
-        for lang in ['ru', 'ky']:
-            get_knowledge_base(lang)
-        global last_cache_update
-        last_cache_update = datetime.now()
+        refresh_coordinator.refresh_sync()
     except Exception as e:
         logger.critical(f"Критическая ошибка при первоначальной загрузке данных: {e}. Бот не может быть запущен.")
         sys.exit(1)
-
-    logger.info("Бот запущен")
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    logger.info(f"Данные загружены из Google за {time.monotonic() - started:.2f} с.")
+
+
+def create_application():
+    """Фабрика приложения: клиент OpenAI, хранилище состояния, обработчики и периодические задачи."""
+    if openai_client is None:
+        init_openai_client()
+    startup_timer.mark('openai_client')
+
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        # Разные чаты обрабатываются параллельно, порядок внутри чата держит chat_dispatcher
+        .concurrent_updates(MAX_CONCURRENT_UPDATES)
+    )
+    if TELEGRAM_API_BASE_URL:
+        builder = builder.base_url(f"{TELEGRAM_API_BASE_URL}/bot").base_file_url(f"{TELEGRAM_API_BASE_URL}/file/bot")
+    if USER_STATE_STORE:
+        # Язык и память диалогов переживают перезапуск и доступны другим воркерам
+        persistence = UserStatePersistence(
+            open_user_store(USER_STATE_STORE, ttl_seconds=USER_IDLE_TTL.total_seconds()),
+            dump_user_data, restore_user_data, update_interval=USER_STATE_FLUSH_SECONDS,
+        )
+        metrics.register_gauges('user_state', persistence.stats)
+        builder = builder.persistence(persistence)
+    application = builder.build()
     application.add_handler(CommandHandler("start", start_command))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message))
     application.add_handler(MessageHandler(filters.VOICE, handle_voice_message))  # Хендлер для голосовых сообщений
 
     application.job_queue.run_repeating(refresh_cache_job, interval=timedelta(minutes=20), first=0)
+    application.job_queue.run_repeating(evict_idle_users_job, interval=timedelta(minutes=30))
+    startup_timer.mark('application')
+    return application
 
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+
+def main():
+    if BOT_MODE == "webhook" and WEBHOOK_WORKERS:
+        # Маршрутизатор сам сообщения не обрабатывает: ни данные, ни клиенты API ему не нужны
+        asyncio.run(run_webhook_router())
+        return
+    startup_timer.mark('imports')
+    load_initial_data()
+    startup_timer.mark('data')
+    application = create_application()
+
+    logger.info("Бот запущен")
+    if BOT_MODE == "webhook":
+        asyncio.run(run_webhook(application))
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,176 @@
+"""Хранилища состояния пользователей (язык и память диалога) вне процесса бота.
+
+Все хранилища синхронные и вызываются из пула потоков (см. state_persistence).
+Значения — словари, пригодные для JSON. Адрес хранилища задается URL:
+    sqlite:///user_state.db   — SQLite в режиме WAL (несколько процессов на одной машине)
+    file://user_state         — каталог с JSON-файлом на пользователя (локально и для тестов)
+    redis://host:6379/0       — Redis, общий для процессов на разных машинах (нужен пакет redis)
+"""
+import contextlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import urllib.parse
+
+
+class SQLiteUserStore:
+    """Состояние в одной таблице SQLite; WAL позволяет читать во время записи из других процессов."""
+
+    def __init__(self, path, ttl_seconds=None):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # При WAL достаточно NORMAL: после сбоя питания теряется только последний пакет записей
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS user_state ("
+            "user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)")
+
+    def load(self, user_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data, updated_at FROM user_state WHERE user_id = ?", (user_id,)).fetchone()
+        if row is None or self._expired(row[1]):
+            return None
+        return json.loads(row[0])
+
+    def _expired(self, updated_at):
+        return self.ttl_seconds is not None and time.time() - updated_at > self.ttl_seconds
+
+    def save_many(self, items):
+        """Записывает пачку {user_id: данные} одной транзакцией."""
+        now = time.time()
+        rows = [(user_id, json.dumps(data, ensure_ascii=False), now) for user_id, data in items.items()]
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(
+                    "INSERT INTO user_state (user_id, data, updated_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+                    rows)
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def delete(self, user_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM user_state WHERE user_id = ?", (user_id,))
+
+    def prune(self):
+        """Удаляет состояние, не обновлявшееся дольше ttl_seconds. Возвращает число удаленных."""
+        if self.ttl_seconds is None:
+            return 0
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM user_state WHERE updated_at < ?", (time.time() - self.ttl_seconds,))
+        return cursor.rowcount
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class FileUserStore:
+    """JSON-файл на пользователя в каталоге; запись атомарна через os.replace."""
+
+    def __init__(self, directory, ttl_seconds=None):
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, user_id):
+        return os.path.join(self.directory, f"{int(user_id)}.json")
+
+    def load(self, user_id):
+        path = self._path(user_id)
+        try:
+            if self.ttl_seconds is not None and time.time() - os.path.getmtime(path) > self.ttl_seconds:
+                return None
+            with open(path, encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save_many(self, items):
+        for user_id, data in items.items():
+            path = self._path(user_id)
+            # Уникальный временный файл: одновременные записи одного пользователя не смешиваются
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=f"{int(user_id)}.", suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, ensure_ascii=False)
+                os.replace(tmp_path, path)
+            except BaseException:
+                with contextlib.suppress(OSError):
+                    os.remove(tmp_path)
+                raise
+
+    def delete(self, user_id):
+        try:
+            os.remove(self._path(user_id))
+        except FileNotFoundError:
+            pass
+
+    def prune(self):
+        if self.ttl_seconds is None:
+            return 0
+        deadline = time.time() - self.ttl_seconds
+        removed = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.json') and entry.stat().st_mtime < deadline:
+                os.remove(entry.path)
+                removed += 1
+        return removed
+
+    def close(self):
+        pass
+
+
+class RedisUserStore:
+    """Состояние в Redis: общий стор для воркеров на разных машинах, устаревание через TTL ключей."""
+
+    def __init__(self, url, ttl_seconds=None, prefix="bot:user:"):
+        import redis  # Необязательная зависимость, нужна только для этого хранилища
+
+        self._redis = redis.Redis.from_url(url)
+        self.ttl_seconds = ttl_seconds
+        self.prefix = prefix
+
+    def load(self, user_id):
+        raw = self._redis.get(f"{self.prefix}{user_id}")
+        return json.loads(raw) if raw is not None else None
+
+    def save_many(self, items):
+        pipeline = self._redis.pipeline(transaction=False)
+        ttl = int(self.ttl_seconds) if self.ttl_seconds else None
+        for user_id, data in items.items():
+            pipeline.set(f"{self.prefix}{user_id}", json.dumps(data, ensure_ascii=False), ex=ttl)
+        pipeline.execute()
+
+    def delete(self, user_id):
+        self._redis.delete(f"{self.prefix}{user_id}")
+
+    def prune(self):
+        # Ключи удаляет сам Redis по истечении TTL
+        return 0
+
+    def close(self):
+        self._redis.close()
+
+
+def open_user_store(url, ttl_seconds=None):
+    """Создает хранилище по URL (см. описание модуля)."""
+    scheme = urllib.parse.urlsplit(url).scheme
+    if scheme == 'sqlite' and url.startswith('sqlite:///'):
+        return SQLiteUserStore(url[len('sqlite:///'):], ttl_seconds=ttl_seconds)
+    if scheme == 'file':
+        return FileUserStore(url[len('file://'):], ttl_seconds=ttl_seconds)
+    if scheme in ('redis', 'rediss'):
+        return RedisUserStore(url, ttl_seconds=ttl_seconds)
+    raise ValueError(f"Неизвестное хранилище состояния пользователей: {url}")
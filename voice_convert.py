@@ -0,0 +1,31 @@
+"""Конвертация голосовых сообщений в MP3 для пула процессов.
+
+Вынесено в отдельный легкий модуль без зависимостей бота: его предзагружает
+сервер forkserver, от которого порождаются рабочие процессы пула (см.
+get_voice_process_pool). Главный модуль (telegram_bot.py) рабочий процесс все
+равно импортирует как __mp_main__ — так устроены forkserver и spawn, — но
+логирование и клиенты API при этом не создаются: логирование настраивается
+только в главном процессе, клиенты создаются при запуске бота.
+"""
+import io
+
+
+class AudioConversionError(Exception):
+    """Аудио не удалось декодировать (CouldntDecodeError из pydub).
+
+    Своя ошибка нужна, чтобы основной процесс ловил ее, не импортируя pydub.
+    """
+
+
+def convert_to_mp3(data, source_format="ogg"):
+    """Декодирует аудио из байтов и возвращает его в MP3. Требует ffmpeg."""
+    from pydub import AudioSegment  # Для работы с аудиофайлами, требует ffmpeg
+    from pydub.exceptions import CouldntDecodeError
+
+    try:
+        audio = AudioSegment.from_file(io.BytesIO(data), format=source_format)
+    except CouldntDecodeError as e:
+        raise AudioConversionError(str(e)) from None
+    output = io.BytesIO()
+    audio.export(output, format="mp3")
+    return output.getvalue()
@@ -0,0 +1,175 @@
+"""Встроенный asyncio HTTP-сервер для приема апдейтов Telegram через webhook.
+
+Сервер понимает ровно то, что нужно Telegram: POST JSON на путь webhook
+с заголовком секрета, keep-alive соединения и GET /healthz для проверки живости.
+
+Для нескольких воркеров один процесс принимает webhook и пересылает апдейт
+воркеру, выбранному по чату (route): все сообщения чата обрабатывает один
+и тот же процесс, поэтому порядок реплик и кэш его состояния сохраняются.
+"""
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'x-telegram-bot-api-secret-token'
+MAX_BODY_BYTES = 1024 * 1024
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+               413: 'Payload Too Large', 500: 'Internal Server Error', 502: 'Bad Gateway'}
+
+
+def update_chat_id(data):
+    """Чат апдейта из сырого JSON (без разбора в Update). Для апдейтов без чата — отправитель."""
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get('chat') or (value.get('message') or {}).get('chat')
+        if chat:
+            return chat.get('id')
+        sender = value.get('from') or value.get('user')
+        if sender:
+            return sender.get('id')
+    return None
+
+
+def route(key, workers):
+    """Воркер для ключа по rendezvous-хешированию.
+
+    Хеш стабилен между процессами (в отличие от hash()), а при добавлении или
+    удалении воркера переезжают только чаты, принадлежавшие изменившемуся воркеру.
+    """
+    def weight(worker):
+        return hashlib.blake2b(f"{worker}:{key}".encode('utf-8'), digest_size=8).digest()
+
+    return max(workers, key=weight)
+
+
+class WebhookServer:
+    """Принимает апдейты и передает их JSON в handle(data).
+
+    Ответ 200 отправляется после того, как handle завершился без ошибки; иначе
+    Telegram получит 5xx и повторит доставку апдейта позже.
+    """
+
+    def __init__(self, handle, path, secret_token=None):
+        self.handle = handle
+        self.path = path
+        self.secret_token = secret_token
+        self.server = None
+        # Открытые соединения: writer -> задача, которая его обслуживает
+        self._connections = {}
+        self.received = 0
+        self.rejected = 0
+        self.failed = 0
+
+    async def start(self, host, port):
+        self.server = await asyncio.start_server(self._serve, host, port)
+        logger.info(f"Webhook-сервер слушает {host}:{port}{self.path}")
+
+    async def stop(self):
+        if self.server is None:
+            return
+        self.server.close()
+        # Keep-alive соединения Telegram закрываем сами, иначе wait_closed будет ждать их вечно
+        for writer in list(self._connections):
+            writer.close()
+        await asyncio.gather(*self._connections.values(), return_exceptions=True)
+        await self.server.wait_closed()
+
+    async def _serve(self, reader, writer):
+        self._connections[writer] = asyncio.current_task()
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except asyncio.IncompleteReadError:
+                    break
+                request_line, *header_lines = head.decode('latin-1').split("\r\n")
+                method, target, _ = request_line.split(' ', 2)
+                headers = {}
+                for line in header_lines:
+                    if ':' in line:
+                        name, value = line.split(':', 1)
+                        headers[name.strip().lower()] = value.strip()
+                length = int(headers.get('content-length', 0))
+                if length > MAX_BODY_BYTES:
+                    await self._respond(writer, 413, close=True)
+                    break
+                body = await reader.readexactly(length) if length else b''
+                status = await self._dispatch(method, target.split('?', 1)[0], headers, body)
+                close = headers.get('connection', '').lower() == 'close'
+                await self._respond(writer, status, close=close)
+                if close:
+                    break
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, ValueError):
+            pass
+        finally:
+            self._connections.pop(writer, None)
+            writer.close()
+
+    async def _dispatch(self, method, path, headers, body):
+        if method == 'GET' and path == '/healthz':
+            return 200
+        if method != 'POST' or path != self.path:
+            return 404
+        if self.secret_token and not hmac.compare_digest(
+                headers.get(SECRET_HEADER, '').encode('utf-8'), self.secret_token.encode('utf-8')):
+            self.rejected += 1
+            logger.warning("Webhook: запрос с неверным секретом отклонен.")
+            return 403
+        try:
+            data = json.loads(body)
+        except ValueError:
+            self.rejected += 1
+            return 400
+        self.received += 1
+        try:
+            await self.handle(data)
+        except Exception:
+            self.failed += 1
+            logger.exception(f"Webhook: ошибка обработки апдейта {data.get('update_id')}")
+            return 500
+        return 200
+
+    @staticmethod
+    async def _respond(writer, status, close=False):
+        body = b'{"ok":true}' if status == 200 else b''
+        writer.write(
+            f"HTTP/1.1 {status} {STATUS_TEXT.get(status, 'OK')}\r\n"
+            f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+            f"Connection: {'close' if close else 'keep-alive'}\r\n\r\n".encode('latin-1') + body
+        )
+        await writer.drain()
+
+    def stats(self):
+        return {'received': self.received, 'rejected': self.rejected, 'failed': self.failed}
+
+
+class UpdateRouter:
+    """Пересылает апдейты воркерам: каждый чат всегда попадает на один и тот же воркер."""
+
+    def __init__(self, workers, path, secret_token=None, timeout=10.0):
+        self.workers = [worker.rstrip('/') for worker in workers]
+        self.path = path
+        self.headers = {SECRET_HEADER: secret_token} if secret_token else {}
+        self.client = httpx.AsyncClient(timeout=timeout)
+        self.forwarded = {worker: 0 for worker in self.workers}
+
+    async def forward(self, data):
+        chat_id = update_chat_id(data)
+        worker = route(chat_id if chat_id is not None else data.get('update_id'), self.workers)
+        response = await self.client.post(f"{worker}{self.path}", json=data, headers=self.headers)
+        # Ошибка воркера уходит в WebhookServer и дальше в Telegram как 500, апдейт будет доставлен повторно
+        response.raise_for_status()
+        self.forwarded[worker] += 1
+
+    async def close(self):
+        await self.client.aclose()
+
+    def stats(self):
+        return {f"forwarded_{index}": count for index, count in enumerate(self.forwarded.values())}